@@ -1,16 +1,34 @@
 import os, sys
 import time
-
+import random
+import socket
+import subprocess
+import multiprocessing
+import json
+import hashlib
+import pipes
+import re
+
+from collections import namedtuple, OrderedDict
 from functools import wraps
+from StringIO import StringIO
+from urllib2 import urlopen, HTTPError, URLError
 
-from fabric.api import cd, env, parallel, roles, run, sudo, execute, warn_only
+from fabric.api import cd, env, parallel, roles, run, sudo, execute, warn_only, put, get, settings, hide
 from fabric.context_managers import quiet, shell_env
 from fabric.contrib.files import exists
-from fabric.decorators import task
+from fabric.decorators import runs_once, task
+from fabric.network import normalize
 from fabric.operations import prompt
+from fabric.state import connections
+from fabric.utils import abort
 
 from socket import gethostname
 
+from fabsupport import artifacts, tracing
+from fabsupport.batch import CommandBatch
+from fabsupport.probes import run_probes
+
 env.hosts = ["localhost"]
 env.roledefs = {
     'spark_nodes': []  # define the IPs for the spark nodes
@@ -29,20 +47,54 @@ HOSTNAME = gethostname()
 IRES_HOME = "%s/IReS-Platform" % ASAP_HOME
 IRES_REPO = "https://github.com/project-asap/IReS-Platform.git"
 IRES_BRANCH = 'project-asap-patch-3'
+# The IReS Maven modules, in build order. They are built with MAVEN_THREADS
+# threads and offline against ~/.m2, which is warmed with their
+# dependencies first, going online only if the offline build fails. Module
+# build times are appended to MAVEN_BUILD_LOG as JSON lines.
+IRES_MODULES = ("panic", "cloudera-kitten", "asap-platform")
+MAVEN_THREADS = "1C"
+MAVEN_BUILD_LOG = 'maven-build-times.jsonl'
 
 SPARK_FORTH_REPO = "https://github.com/project-asap/spark01.git"
 SPARK_FORTH_HOME = "/".join([ASAP_HOME, SPARK_FORTH_REPO.split('/')[-1].rsplit('.', 1)[0]])
 SPARK_FORTH_BRANCH = "final"
+# The assembly is built once, on the spark master, and relayed to the other
+# spark_nodes. It is rebuilt only when the checked out commit, the Hadoop
+# version or SBT_VERSION differ from those recorded in the stamp file.
+SPARK_FORTH_ASSEMBLY = "assembly/target/scala-2.10/spark-assembly-*.jar"
+SPARK_FORTH_BUILD_STAMP = "assembly/target/.build-stamp"
 def _get_local_ip():
     r = run("ifconfig $1 | grep \"inet addr\" | gawk -F: '{print $2}' | gawk '{print $1}'")
     return [ip for ip in r.split() if ip != "127.0.0.1"][0]
-SPARK_MASTER = env.roledefs['spark_master'][0] \
-    if len(env.roledefs['spark_master']) >= 1 \
-    else _get_local_ip()
+_spark_master = []
+
+def spark_master():
+    # The first spark_master, or else the IP of the node the task runs on.
+    # Looked up once, when first needed, rather than whenever fab loads the
+    # fabfile (even to list the tasks).
+    if not _spark_master:
+        masters = env.roledefs['spark_master']
+        _spark_master.append(masters[0] if masters else _get_local_ip())
+    return _spark_master[0]
 
 SPARK_VERSION = '1.6.0'
 SPARK_DOWNLOAD_LINK = 'http://d3kbcqa49mib13.cloudfront.net/spark-%s-bin-without-hadoop.tgz' % SPARK_VERSION
 SPARK_HOME = "/".join([ASAP_HOME, SPARK_DOWNLOAD_LINK.split('/')[-1].rsplit('.', 1)[0]])
+SPARK_SHA256 = None  # checked after download if set
+# configure_spark and configure_spark_forth size Spark from the hardware of
+# the spark nodes, probed in parallel. SPARK_RESERVED_CORES cores and
+# SPARK_RESERVED_MEMORY MB (or a tenth of the RAM, if more) are left to the
+# OS and the other daemons of a node. Executors get SPARK_EXECUTOR_CORES
+# cores each and are sized to fit the smallest node. SPARK_CONF entries
+# override the generated spark-defaults.conf settings. Spark scratch space
+# goes to the writable disks mounted on a path matching
+# SPARK_LOCAL_DIR_MOUNTS, or to /tmp on nodes without such a disk.
+SPARK_RESERVED_CORES = 1
+SPARK_RESERVED_MEMORY = 1024
+SPARK_EXECUTOR_CORES = 4
+SPARK_CONF = {}
+SPARK_CONF_FILES = ('conf/spark-env.sh', 'conf/spark-defaults.conf', 'conf/slaves')
+SPARK_LOCAL_DIR_MOUNTS = r'^/(mnt|data|disk)[0-9]*(/|$)'
 
 SPARK_FORTH_TESTS_HOME = "%s/spark-tests" % ASAP_HOME
 SPARK_FORTH_TESTS_REPO = "https://github.com/project-asap/spark-tests.git"
@@ -51,11 +103,43 @@ SWAN_HOME = "%s/swan" % ASAP_HOME
 SWAN_LLVM_REPO = "https://github.com/project-asap/swan_llvm.git"
 SWAN_CLANG_REPO = "https://github.com/project-asap/swan_clang.git"
 SWAN_RT_REPO = "https://github.com/project-asap/swan_runtime.git"
+SWAN_TESTS_REPO = "https://github.com/project-asap/swan_tests.git"
+# Swan is built incrementally with SWAN_BUILD_JOBS parallel jobs (None for
+# the core count of the node) and, with SWAN_USE_CCACHE, through ccache. A
+# component is only rebuilt when its sources or build settings change; the
+# build time of every component is appended to SWAN_BUILD_LOG, on the
+# machine running fab, as JSON lines.
+SWAN_BUILD_JOBS = None
+SWAN_USE_CCACHE = True
+SWAN_BUILD_LOG = 'swan-build-times.jsonl'
+# Built toolchains (the LLVM/Clang binaries and the runtime) are published to
+# the artifact cache, keyed by the upstream revisions of the three repos and
+# the node's platform, and other nodes unpack them instead of building from
+# source. Set SWAN_PREBUILT to False to always build from source.
+SWAN_PREBUILT = True
+SWAN_TOOLCHAIN_PATHS = ('build/bin', 'build/lib/clang', 'swan_runtime')
 
 SBT_VERSION = "0.13.11"
 
 VHOST = "asap"
 
+# Bootstrap stages may install packages concurrently; apt-get calls are
+# serialized on this lock file instead of failing on the dpkg lock.
+APT_LOCK = "/tmp/asap-apt.lock"
+
+# Repositories are fetched into shallow bare mirrors under GIT_MIRROR_DIR on
+# each node. Checkouts are shallow single-branch clones of their mirror and
+# are updated in place, with a fetch and a checkout, on later runs.
+GIT_MIRROR_DIR = "%s/.git-mirrors" % ASAP_HOME
+
+# Services are polled until ready with exponential backoff (and jitter),
+# starting at READY_INITIAL_DELAY seconds and capped at READY_MAX_DELAY.
+READY_TIMEOUT = 100
+READY_INITIAL_DELAY = 0.25
+READY_MAX_DELAY = 5
+
+tracing.install(globals())
+
 def yes_or_no(s):
     if s not in ('y', 'n'):
         raise Exception('Just say yes (y) or no (n).')
@@ -72,7 +156,7 @@ def acknowledge(msg):
     return wrap
 
 def install_package(package):
-    sudo('apt-get install %s' % package)
+    sudo('flock %s apt-get -y install %s' % (APT_LOCK, package))
 
 def uninstall_package(package):
     @acknowledge('Do you want to remove %s?' % package)
@@ -98,22 +182,120 @@ def uninstall_requirements(requirements=()):
         return wrapped
     return wrap
 
+def git_checkout(repo, path, branch=None):
+    run(git_checkout_command(repo, path, branch))
+
+def git_checkout_command(repo, path, branch=None):
+    # Updates (or creates) the mirror of repo and then the checkout at path,
+    # with the default branch of the repo if no branch is given. Mirrors are
+    # created on the default branch so that their HEAD keeps pointing at it.
+    mirror = os.path.join(GIT_MIRROR_DIR, os.path.basename(repo).rsplit('.git', 1)[0] + '.git')
+    return ('{ [ -d %(mirror)s ] || { mkdir -p %(mirrors)s && '
+            'git clone -q --bare --depth 1 --single-branch %(repo)s %(mirror)s; }; } && '
+            'git --git-dir=%(mirror)s fetch -q --depth 1 origin +refs/heads/%(branch)s:refs/heads/%(branch)s && '
+            'if [ -d %(path)s/.git ]; then cd %(path)s && '
+            'git fetch -q --depth 1 file://%(mirror)s %(branch)s && '
+            '{ [ "$(git rev-parse HEAD)" = "$(git rev-parse FETCH_HEAD)" ] || '
+            'git checkout -q -f -B %(branch)s FETCH_HEAD; }; '
+            'else git clone -q --depth 1 --single-branch -b %(branch)s file://%(mirror)s %(path)s; fi' %
+            {'repo': repo, 'path': path, 'mirror': mirror, 'mirrors': GIT_MIRROR_DIR,
+             'branch': branch or '$(git --git-dir=%s symbolic-ref --short HEAD)' % mirror})
+
 def change_xml_property(name, value, file_):
     run("sed -i 's/\(<%s>\)\([^\"]*\)\(<\/%s>\)/\\1%s\\3/g' %s" %
         (name, name, value, file_))
 
 
-def ping_service(url, status):
-    with quiet():
-        return run('curl -s -o /dev/null -w "%%{http_code}" %s' % url) == status
+Probe = namedtuple('Probe', ['kind', 'target', 'expected'])
+
+def http_probe(url, status='200'):
+    return Probe('http', url, status)
+
+def tcp_probe(host, port):
+    return Probe('tcp', '%s:%s' % (host, port), None)
+
+def process_probe(pattern):
+    return Probe('process', pattern, None)
+
+READINESS_TIMINGS = {}
 
-def wait_until(somepredicate, timeout=100, period=0.25, *args, **kwargs):
-    t = time.time()
-    mustend = t + timeout
-    while time.time() < mustend:
-        if somepredicate(*args, **kwargs): return
-        time.sleep(period)
+def wait_for(service, probes, timeout=READY_TIMEOUT, local=None):
+    # Probes of services on the machine running fab are run right here;
+    # otherwise a single remote shell loop polls them, instead of one ssh
+    # command per attempt.
+    if local is None:
+        local = env.host in (None, 'localhost', '127.0.0.1')
+    started = time.time()
+    failing = _wait_locally(probes, timeout) if local else _wait_remotely(probes, timeout)
+    if failing:
+        abort('%s not ready on %s after %ds, failing probes: %s' %
+              (service, env.host, timeout, ', '.join(failing)))
+    elapsed = time.time() - started
+    READINESS_TIMINGS[(service, env.host)] = elapsed
+    print('%s ready on %s after %.1fs' % (service, env.host, elapsed))
+    return elapsed
 
+def _describe_probe(probe):
+    if probe.kind == 'http':
+        return '%s %s' % (probe.target, probe.expected)
+    return '%s %s' % (probe.kind, probe.target)
+
+def _probe_locally(probe):
+    if probe.kind == 'http':
+        try:
+            status = urlopen(probe.target, timeout=5).getcode()
+        except HTTPError as e:
+            status = e.code
+        except (URLError, socket.error):
+            return False
+        return str(status) == probe.expected
+    if probe.kind == 'tcp':
+        host, port = probe.target.rsplit(':', 1)
+        try:
+            socket.create_connection((host, int(port)), 5).close()
+        except socket.error:
+            return False
+        return True
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['pgrep', '-f', probe.target], stdout=devnull) == 0
+
+def _wait_locally(probes, timeout):
+    deadline = time.time() + timeout
+    delay = READY_INITIAL_DELAY
+    while True:
+        failing = [_describe_probe(probe) for probe in probes if not _probe_locally(probe)]
+        if not failing or time.time() >= deadline:
+            return failing
+        time.sleep(min(delay * random.uniform(0.5, 1), max(0, deadline - time.time())))
+        delay = min(delay * 2, READY_MAX_DELAY)
+
+def _probe_command(probe):
+    if probe.kind == 'http':
+        return '[ "$(curl -s -m 5 -o /dev/null -w "%%{http_code}" %s)" = %s ]' % (
+            probe.target, probe.expected)
+    if probe.kind == 'tcp':
+        host, port = probe.target.rsplit(':', 1)
+        return "timeout 5 bash -c 'exec 3<>/dev/tcp/%s/%s' 2>/dev/null" % (host, port)
+    # [x]yz still matches xyz but not the command line of this very script
+    return "pgrep -f '[%s]%s' >/dev/null" % (probe.target[0], probe.target[1:])
+
+def _wait_remotely(probes, timeout):
+    checks = [(_probe_command(probe), _describe_probe(probe)) for probe in probes]
+    script = ('delay=%(delay)s; end=$((SECONDS + %(timeout)d)); '
+              'while ! { %(ready)s; }; do '
+              'if [ $SECONDS -ge $end ]; then %(report)s exit 1; fi; '
+              'sleep $(awk -v d=$delay -v r=$RANDOM \'BEGIN { print d * (0.5 + r / 65534) }\'); '
+              'delay=$(awk -v d=$delay \'BEGIN { d *= 2; print (d > %(max)s) ? %(max)s : d }\'); '
+              'done' % {
+                  'delay': READY_INITIAL_DELAY, 'timeout': timeout, 'max': READY_MAX_DELAY,
+                  'ready': ' && '.join(command for command, _ in checks),
+                  'report': ' '.join("%s || echo 'failing: %s';" % check for check in checks)})
+    with settings(hide('everything'), warn_only=True):
+        output = run(script)
+    if output.succeeded:
+        return []
+    return [line[len('failing: '):] for line in output.splitlines()
+            if line.startswith('failing: ')] or ['unknown']
 
 def upload_to_hdfs(local_path, hdfs_path):
     run('hdfs dfs -put -f %s %s' % (local_path, hdfs_path))
@@ -128,9 +310,8 @@ def config_npm():
 
 @task
 def config_grunt():
-    if not exists("/usr/bin/node"):
-        # create symbolic link for nodejs
-        sudo("ln -s /usr/bin/nodejs /usr/bin/node")
+    # create symbolic link for nodejs
+    sudo("[ -e /usr/bin/node ] || ln -s /usr/bin/nodejs /usr/bin/node")
 
 
 @task
@@ -142,13 +323,13 @@ def config_wmt():
         sudo("sed -ri \"s/(listen)(.*)(;)/\\1\\t%s\\3/\" %s" % (WMT_PORT, sites_available))
         sudo("sed -ri \"s/\/Users\/max\/Projects\/workflow/%s/\" %s" %
                 ('\/'.join(WMT_HOME.split('/')), sites_available))
-        if exists(sites_enabled):
-            sudo("rm %s" % sites_enabled)
-        sudo("ln -s %s %s" % (sites_available, sites_enabled))
+        sudo("ln -sf %s %s" % (sites_available, sites_enabled))
 
 @task
 def start_nginx():
     sudo('/etc/init.d/nginx restart')
+    wait_for('nginx/WMT', [process_probe('nginx: master'),
+                           http_probe('http://localhost:%s/main.html' % WMT_PORT)])
 
 @task
 @acknowledge('Do you want to stop nginx?')
@@ -159,13 +340,14 @@ def stop_nginx():
 
 @task
 def install_wmt():
-    if not exists(WMT_HOME):
-        with cd(ASAP_HOME):
-            run("git clone %s" % WMT_REPO)
-    with cd(WMT_HOME):
-        run('git checkout %s' % WMT_BRANCH)
-        run("npm install")
-        run("grunt")
+    git_checkout(WMT_REPO, WMT_HOME, WMT_BRANCH)
+    with CommandBatch('wmt') as batch:
+        with cd(WMT_HOME):
+            # Only when package.json changed, and from the local cache if possible
+            batch.run('h=$(md5sum package.json | cut -d " " -f 1); '
+                      '[ "$(cat node_modules/.package-json.md5 2>/dev/null)" = "$h" ] || '
+                      '{ npm install --prefer-offline && echo $h > node_modules/.package-json.md5; }')
+            batch.run("grunt")
 
 @task
 @install_requirements(('python-ruamel.yaml',))
@@ -204,17 +386,45 @@ def check_for_yarn():
         HADOOP_VERSION = run("%s/bin/yarn version|head -1|cut -d ' ' -f 2" % HADOOP_PREFIX)
     return HADOOP_PREFIX, HADOOP_VERSION
 
+def warm_maven_cache(modules):
+    # Resolves the dependencies of every module into ~/.m2, again only when
+    # its pom.xml changed. Dependencies between the modules can't be
+    # resolved before they are installed, so failures are not fatal.
+    with CommandBatch('maven_cache') as batch:
+        for module in modules:
+            batch.run('h=$(md5sum %(module)s/pom.xml | cut -d " " -f 1); '
+                      '[ "$(cat %(module)s/target/.m2-warmed 2>/dev/null)" = "$h" ] || '
+                      '{ mvn -B -q --fail-never -f %(module)s/pom.xml dependency:go-offline; '
+                      'mkdir -p %(module)s/target && echo $h > %(module)s/target/.m2-warmed; }' %
+                      {'module': module})
+
+def maven_build(component, modules, goals):
+    with CommandBatch(component) as batch:
+        for module in modules:
+            batch.run('mvn -B -o -T %(threads)s -f %(module)s/pom.xml %(goals)s || '
+                      'mvn -B -T %(threads)s -f %(module)s/pom.xml %(goals)s' %
+                      {'threads': MAVEN_THREADS, 'module': module, 'goals': goals})
+    _record_build_time(MAVEN_BUILD_LOG, component, batch.results, goals=goals,
+                       threads=MAVEN_THREADS)
+    return batch.results
+
+@task
+def wait_for_hadoop():
+    # Hadoop daemons run with -Dproc_<daemon> on their command line; the
+    # NameNode and ResourceManager web UIs listen on all interfaces.
+    wait_for('Hadoop', [process_probe('proc_namenode'), process_probe('proc_datanode'),
+                        process_probe('proc_resourcemanager'), process_probe('proc_nodemanager'),
+                        tcp_probe('localhost', 50070), tcp_probe('localhost', 8088)])
+
 def clone_IReS():
-    if not exists(IRES_HOME):
-        with cd(ASAP_HOME):
-            run("git clone %s" % IRES_REPO)
+    git_checkout(IRES_REPO, IRES_HOME, IRES_BRANCH)
 
 @task
 def start_IReS():
     with cd(IRES_HOME):
         with shell_env(ASAP_SERVER_HOME='%s' % os.path.join(IRES_HOME, 'asap-platform/asap-server/target')):
             run("nohup ./asap-platform/asap-server/src/main/scripts/asap-server start")
-    wait_until(ping_service, url='http://localhost:1323', status='200')
+    wait_for('IReS', [http_probe('http://localhost:1323')])
 
 @task
 def stop_IReS():
@@ -227,9 +437,7 @@ def stop_IReS():
 def test_IReS():
     with shell_env(ASAP_HOME='%s' % IRES_HOME):
         with cd(IRES_HOME):
-            for d in ("panic", "cloudera-kitten", "asap-platform"):
-                with cd(d):
-                    run("mvn -Dmaven.test.failure.ignore verify")
+            maven_build('IReS_tests', IRES_MODULES, '-Dmaven.test.failure.ignore verify')
 
 
 @task
@@ -248,14 +456,12 @@ def bootstrap_IReS_old():
     def build():
         # Conditional build
         if not exists("asap-platform/asap-server/target"):
-            for d in ("panic", "cloudera-kitten", "asap-platform"):
-                with cd(d):
-                    run("mvn clean install -DskipTests")
+            maven_build('IReS', IRES_MODULES, 'install -DskipTests')
 
     clone_IReS()
 
     with cd(IRES_HOME):
-        run("git checkout %s" % IRES_BRANCH)
+        warm_maven_cache(IRES_MODULES)
         # Temporary hack for solving temporary issues with inner dependencies
         with quiet():
             build()
@@ -272,10 +478,18 @@ def bootstrap_IReS_old():
 
 @task
 def install_IReS():
+    # What install.sh does, but through maven_build: offline against the
+    # warmed cache and without cleaning the previous build first
     clone_IReS()
     with cd(IRES_HOME):
-        HADOOP_PREFIX, _ = check_for_yarn()
-        run('./install.sh')
+        HADOOP_PREFIX, HADOOP_VERSION = check_for_yarn()
+        for f in ('asap-platform/pom.xml', 'cloudera-kitten/pom.xml'):
+            change_xml_property('hadoop.version', HADOOP_VERSION, f)
+        warm_maven_cache(IRES_MODULES)
+        maven_build('IReS', IRES_MODULES, 'install -DskipTests')
+        for f in ('core-site.xml', 'yarn-site.xml'):
+            run('ln -sf %s/etc/hadoop/%s asap-platform/asap-server/target/conf/' %
+                (HADOOP_PREFIX, f))
 
 @task
 @install_requirements(('maven',))
@@ -286,15 +500,11 @@ def bootstrap_IReS():
     #run_IReS_examples()
 
 def clone_spark_forth():
-    if not exists(SPARK_FORTH_HOME):
-        with cd(ASAP_HOME):
-            run("git clone %s %s" % (SPARK_FORTH_REPO, SPARK_FORTH_HOME))
+    git_checkout(SPARK_FORTH_REPO, SPARK_FORTH_HOME, SPARK_FORTH_BRANCH)
 
 
 def clone_spark_forth_tests():
-    if not exists(SPARK_FORTH_TESTS_HOME):
-        with cd(ASAP_HOME):
-            run("git clone %s" % SPARK_FORTH_TESTS_REPO)
+    git_checkout(SPARK_FORTH_TESTS_REPO, SPARK_FORTH_TESTS_HOME)
 
 @task
 @roles('spark_master')
@@ -303,6 +513,7 @@ def start_spark_forth():
         stop_spark()
     with cd(SPARK_FORTH_HOME):
         run("./sbin/start-all.sh")
+    wait_for_spark_master()
 
 
 @task
@@ -312,6 +523,11 @@ def start_spark():
         stop_spark_forth()
     with cd(SPARK_HOME):
         run("./sbin/start-all.sh")
+    wait_for_spark_master()
+
+def wait_for_spark_master():
+    wait_for('Spark master', [tcp_probe(spark_master(), 7077),
+                              http_probe('http://%s:8080' % spark_master())])
 
 @task
 @roles('spark_master')
@@ -330,13 +546,13 @@ def stop_spark():
 def build_spark_forth_tests():
     install_sbt()
 
-    with cd(SPARK_FORTH_TESTS_HOME):
+    with CommandBatch('spark_forth_tests') as batch, cd(SPARK_FORTH_TESTS_HOME):
         library_path = os.path.join(SPARK_FORTH_TESTS_HOME, 'lib')
 
         # copy spark-assembly jar to the library
-        run("mkdir -p %s" % library_path)
-        run("cp %s/assembly/target/scala-2.10/spark-assembly-*.jar lib/" % SPARK_FORTH_HOME)
-        run("sbt clean package")
+        batch.run("mkdir -p %s" % library_path)
+        batch.run("cp %s/%s lib/" % (SPARK_FORTH_HOME, SPARK_FORTH_ASSEMBLY))
+        batch.run("sbt clean package")
 
 @task
 @roles('spark_master')
@@ -345,7 +561,7 @@ def test_spark_forth_nested():
         for clss in ('NestedMap1', 'NestedFilter1'):
             run("%s/bin/spark-submit --class %s "
                 "target/scala-2.10/spark-tests_2.10-1.0.jar spark://%s:7077" %
-                (SPARK_FORTH_HOME, clss, SPARK_MASTER))
+                (SPARK_FORTH_HOME, clss, spark_master()))
 @task
 @roles('spark_master')
 def test_spark_forth_hierarchical():
@@ -354,7 +570,7 @@ def test_spark_forth_hierarchical():
         run("%s/bin/spark-submit --class HierarchicalKMeansPar "
             "target/scala-2.10/spark-tests_2.10-1.0.jar spark://%s:7077 "
             "100 2 2 2 /tmp/test0.txt --dist-sched false" %
-            (SPARK_FORTH_HOME, SPARK_MASTER))
+            (SPARK_FORTH_HOME, spark_master()))
 
 @task
 @roles('spark_master')
@@ -364,7 +580,7 @@ def test_spark_forth_distributed_scheduler():
         "target/scala-2.10/spark-tests_2.10-1.0.jar "
         "--master spark://%s:7077 --algo Filter33 --dist-sched true "
         "--nsched 4 --partitions 32 --runs 15" %
-        (SPARK_FORTH_HOME, SPARK_MASTER))
+        (SPARK_FORTH_HOME, spark_master()))
 
 @task
 @roles('spark_master')
@@ -379,80 +595,197 @@ def test_spark_forth():
 @roles('spark_master')
 def test_spark():
     with cd(SPARK_HOME):
-        run('MASTER=spark://%s:7077 ./bin/run-example SparkPi' % SPARK_MASTER)
+        run('MASTER=spark://%s:7077 ./bin/run-example SparkPi' % spark_master())
 
 @task
 def install_sbt():
-    try:
-        run("sbt help")
-    except:
-        sbt_url = 'https://dl.bintray.com/sbt/debian'
-        try:
-            run("grep %s /etc/apt/sources.list.d/sbt.list" % sbt_url)
-        except:
+    sbt_url = 'https://dl.bintray.com/sbt/debian'
+    probes = run_probes({
+        'sbt': 'sbt help',
+        'source': 'grep %s /etc/apt/sources.list.d/sbt.list' % sbt_url,
+    })
+    if probes['sbt'][0] != 0:
+        if probes['source'][0] != 0:
             run("echo \"deb https://dl.bintray.com/sbt/debian /\" | sudo tee -a /etc/apt/sources.list.d/sbt.list")
         sudo("apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv 642AC823")
-        sudo("apt-get update")
-        sudo("apt-get install sbt")
+        sudo("flock %s apt-get update" % APT_LOCK)
+        install_package('sbt')
 
 
 @task
-@parallel
-@roles('spark_nodes')
+@runs_once
+@roles('spark_master')
 def build_spark_forth():
     clone_spark_forth()
 
+    _, HADOOP_VERSION = check_for_yarn()
     with cd(SPARK_FORTH_HOME):
-        _, HADOOP_VERSION = check_for_yarn()
-        run("git checkout %s" % SPARK_FORTH_BRANCH)
-
         # Change sbt version causing IllegalStateException https://github.com/sbt/sbt/issues/2015
         run("sed -i \"/sbt.version=/ s/=.*/=%s/\" project/build.properties" % SBT_VERSION)
 
-        run("./build/sbt -Dhadoop.version=%s -Pyarn -DskipTests clean assembly"
-             % HADOOP_VERSION)
+        probes = run_probes({
+            'commit': 'git rev-parse HEAD',
+            'stamp': 'cat %s' % SPARK_FORTH_BUILD_STAMP,
+            'assembly': 'ls %s' % SPARK_FORTH_ASSEMBLY,
+        })
+        stamp = '%s hadoop-%s sbt-%s' % (probes['commit'][1], HADOOP_VERSION, SBT_VERSION)
+        if probes['stamp'][1] == stamp and probes['assembly'][0] == 0:
+            print('The spark-forth assembly is up to date (%s)' % stamp)
+        else:
+            # No clean: sbt and the ivy cache in ~/.ivy2 only rebuild what changed
+            with CommandBatch('spark_forth') as batch:
+                batch.run("./build/sbt -Dhadoop.version=%s -Pyarn -DskipTests assembly"
+                          % HADOOP_VERSION)
+                # Assemblies for other Hadoop versions would be left behind
+                batch.run("ls -t %s | tail -n +2 | xargs rm -f" % SPARK_FORTH_ASSEMBLY)
+                batch.run("echo '%s' > %s" % (stamp, SPARK_FORTH_BUILD_STAMP))
+        with settings(hide('everything')):
+            assembly = run("ls -t %s | head -n 1" % SPARK_FORTH_ASSEMBLY).strip()
+
+    distribute_spark_forth_assembly(os.path.join(SPARK_FORTH_HOME, assembly))
+
+def distribute_spark_forth_assembly(assembly):
+    nodes = env.roledefs['spark_nodes']
+    # Role entries may be user@host strings
+    workers = [host for host in nodes if normalize(host)[1] != env.host]
+    if not workers:
+        return
+    execute(prepare_spark_forth_worker, os.path.basename(assembly), hosts=workers)
+    with settings(hide('everything')):
+        digest = run("sha256sum %s | cut -d ' ' -f 1" % assembly).strip()
+    # The master already holds the assembly and serves it to the workers
+    artifacts.distribute_file(None, assembly, hosts=nodes, digest=digest)
 
+@parallel
+def prepare_spark_forth_worker(assembly_name):
+    # Workers need the scripts from the checkout but not a build of their own
+    clone_spark_forth()
+    with CommandBatch('spark_forth_worker') as batch, cd(SPARK_FORTH_HOME):
+        batch.run("mkdir -p %s" % os.path.dirname(SPARK_FORTH_ASSEMBLY))
+        batch.run("find %s -name 'spark-assembly-*.jar' ! -name '%s' -delete" %
+                  (os.path.dirname(SPARK_FORTH_ASSEMBLY), assembly_name))
+
+
+def configure_spark_basic(spark_dir, env_vars=None, env_probes=None):
+    # Probes every spark node once, in parallel, then writes its spark-env.sh,
+    # spark-defaults.conf and (on the master) slaves, skipping unchanged ones.
+    # env_vars are exported as is and env_probes, {name: command}, with the
+    # output of the command on each node.
+    nodes = env.roledefs['spark_nodes'] or env.hosts
+    facts = execute(probe_spark_node, spark_dir, env_probes or {}, hosts=nodes)
+    for host, node in facts.items():
+        failed = [name for name, (code, _) in node.items() if code and name != 'digests']
+        if failed:
+            abort('Probing %s on %s failed: %s' %
+                  (', '.join(failed), host, '; '.join(node[name][1] for name in failed)))
+
+    resources = dict((host, _spark_resources(node)) for host, node in facts.items())
+    worker_cores = min(cores for cores, _ in resources.values())
+    worker_memory = min(memory for _, memory in resources.values())
+    executor_cores = min(SPARK_EXECUTOR_CORES, worker_cores)
+    # A tenth of each executor's share is left for off-heap memory
+    executor_memory = int(worker_memory / (worker_cores // executor_cores) * 0.9)
+
+    defaults = OrderedDict([
+        ('spark.rpc', 'akka'),
+        ('spark.executor.cores', executor_cores),
+        ('spark.executor.memory', '%dm' % executor_memory),
+        ('spark.default.parallelism', 2 * sum(cores for cores, _ in resources.values())),
+        ('spark.serializer', 'org.apache.spark.serializer.KryoSerializer'),
+        ('spark.kryoserializer.buffer.max', '256m'),
+        ('spark.shuffle.file.buffer', '64k'),
+    ])
+    defaults.update(SPARK_CONF)
+    execute(write_spark_conf, spark_dir, nodes, facts, resources, defaults,
+            env_vars or {}, hosts=nodes)
 
-def configure_spark_basic(spark_dir):
-    with cd(spark_dir):
-        run("cp conf/spark-env.sh.template conf/spark-env.sh")
-        run("sed -i '/SPARK_MASTER_IP/a SPARK_MASTER_IP=%s' conf/spark-env.sh" % SPARK_MASTER)
-        # TODO set PYSPARK_PYTHON
-        # TODO set HADOOP_CONFDIR
-        run("cp conf/spark-defaults.conf.template conf/spark-defaults.conf")
-        run("echo 'spark.rpc akka' >> conf/spark-defaults.conf")
-        if env.host == SPARK_MASTER:
-            run("cp conf/slaves.template conf/slaves")
-            run("sed -i '/localhost/a %s' conf/slaves" % '\\n'.join(env.roledefs['spark_nodes']))
-            run("sed -i '/localhost/d' conf/slaves")
+@parallel
+def probe_spark_node(spark_dir, env_probes):
+    probes = {
+        'cores': 'nproc',
+        'memory': "awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo",
+        'mounts': "awk '$1 ~ \"^/dev/\" && $4 ~ \"^rw(,|$)\" {print $2}' /proc/mounts | "
+                  "sort -u | while read m; do [ -d \"$m\" ] && echo \"$m\"; done; true",
+        'digests': 'cd %s && md5sum %s' % (spark_dir, ' '.join(SPARK_CONF_FILES)),
+    }
+    probes.update(env_probes)
+    return run_probes(probes)
+
+def _spark_resources(node):
+    # The (cores, memory in MB) a node leaves to its Spark worker
+    cores, memory = int(node['cores'][1]), int(node['memory'][1])
+    reserved = max(SPARK_RESERVED_MEMORY, memory // 10)
+    return max(1, cores - SPARK_RESERVED_CORES), max(512, memory - reserved)
+
+def _spark_local_dirs(node):
+    # Scratch space is spread over the data disks, if the node has any
+    mounts = [mount for mount in node['mounts'][1].splitlines()
+              if re.match(SPARK_LOCAL_DIR_MOUNTS, mount) and not re.match(r'/boot(/|$)', mount)]
+    return [os.path.join(mount, 'spark-local') for mount in mounts] or ['/tmp/spark-local']
+
+@parallel
+def write_spark_conf(spark_dir, nodes, facts, resources, defaults, env_vars):
+    node = facts[env.host_string]
+    worker_cores, worker_memory = resources[env.host_string]
+    local_dirs = _spark_local_dirs(node)
+
+    variables = OrderedDict([
+        ('SPARK_MASTER_IP', spark_master()),
+        ('SPARK_WORKER_CORES', worker_cores),
+        ('SPARK_WORKER_MEMORY', '%dm' % worker_memory),
+        ('SPARK_LOCAL_DIRS', ','.join(local_dirs)),
+    ])
+    variables.update(sorted(env_vars.items()))
+    variables.update((name, node[name][1]) for name in sorted(node)
+                     if name not in ('cores', 'memory', 'mounts', 'digests'))
+    node_defaults = OrderedDict(defaults)
+    node_defaults.setdefault('spark.local.dir', ','.join(local_dirs))
+
+    header = '# Generated by fab, changes are overwritten\n'
+    files = {
+        'conf/spark-env.sh': header + ''.join('export %s=%s\n' % (name, pipes.quote(str(value)))
+                                              for name, value in variables.items()),
+        'conf/spark-defaults.conf': header + ''.join('%s %s\n' % item
+                                                     for item in node_defaults.items()),
+    }
+    if env.host == spark_master():
+        files['conf/slaves'] = ''.join('%s\n' % host.split('@')[-1].split(':')[0]
+                                       for host in nodes)
+
+    digests = dict(line.split()[::-1] for line in node['digests'][1].splitlines()
+                   if re.match(r'^[0-9a-f]{32}  ', line))
+    changed = [name for name in sorted(files)
+               if hashlib.md5(files[name]).hexdigest() != digests.get(name)]
+    for name in changed:
+        put(StringIO(files[name]), os.path.join(spark_dir, name))
+    run("mkdir -p %(dirs)s 2>/dev/null || "
+        "{ sudo mkdir -p %(dirs)s && sudo chown %(user)s %(dirs)s; }" %
+        {'dirs': ' '.join(local_dirs), 'user': env.user})
+    print('%s: %d cores, %d MB for Spark; %s' %
+          (env.host, worker_cores, worker_memory,
+           'wrote %s' % ', '.join(changed) if changed else 'configuration unchanged'))
 
 
 @task
-@parallel
+@runs_once
 @roles('spark_nodes')
 def configure_spark_forth():
     configure_spark_basic(SPARK_FORTH_HOME)
 
 @task
-@parallel
+@runs_once
 @roles('spark_nodes')
 def configure_spark():
-    configure_spark_basic(SPARK_HOME)
-    with cd(SPARK_HOME):
-        HADOOP_PREFIX, _ = check_for_yarn()
-        hadoop_classpath = run("%s/bin/hadoop classpath" % HADOOP_PREFIX)
-        run("echo 'export SPARK_DIST_CLASSPATH=%s' >> conf/spark-env.sh" % hadoop_classpath)
-        JAVA_HOME = os.environ['JAVA_HOME']
-        run("echo 'export JAVA_HOME=%s' >> conf/spark-env.sh" % JAVA_HOME)
+    HADOOP_PREFIX, _ = check_for_yarn()
+    configure_spark_basic(SPARK_HOME, env_vars={'JAVA_HOME': os.environ['JAVA_HOME']},
+                          env_probes={'SPARK_DIST_CLASSPATH': '%s/bin/hadoop classpath' % HADOOP_PREFIX})
 
 
 @task
 def download_spark():
+    tarball = SPARK_DOWNLOAD_LINK.split('/')[-1]
+    artifacts.distribute_artifact(SPARK_DOWNLOAD_LINK, os.path.join(ASAP_HOME, tarball), SPARK_SHA256)
     with cd(ASAP_HOME):
-        tarball = SPARK_DOWNLOAD_LINK.split('/')[-1]
-        if (not exists(tarball)):
-            run('wget %s' % SPARK_DOWNLOAD_LINK)
-        tarball = SPARK_DOWNLOAD_LINK.split('/')[-1]
         run('tar -xvf %s' % tarball)
 
 @task
@@ -471,7 +804,7 @@ def bootstrap_spark_forth():
 
 @task
 def install_libnumadev():
-    sudo('apt-get install libnuma-dev')
+    install_package('libnuma-dev')
 
 @task
 @acknowledge('Do you want to remove libnuma-dev?')
@@ -479,64 +812,285 @@ def uninstall_libnumadev():
     sudo("apt-get purge libnuma-dev")
 @task
 def test_clang():
-    with cd(SWAN_HOME):
+    with CommandBatch('test_clang') as batch, cd(SWAN_HOME):
         with shell_env(PATH='$PATH:%s/build/bin' % SWAN_HOME):
-            run('clang --help')
-            run('clang++ --help')
-            run('clang llvm/utils/count/count.c -fsyntax-only')
-            run('clang llvm/utils/count/count.c -S -emit-llvm -o -')
-            run('clang llvm/utils/count/count.c -S -emit-llvm -o - -O3')
-            run('clang llvm/utils/count/count.c -S -O3 -o -')
+            batch.run('clang --help')
+            batch.run('clang++ --help')
+            batch.run('clang llvm/utils/count/count.c -fsyntax-only')
+            batch.run('clang llvm/utils/count/count.c -S -emit-llvm -o -')
+            batch.run('clang llvm/utils/count/count.c -S -emit-llvm -o - -O3')
+            batch.run('clang llvm/utils/count/count.c -S -O3 -o -')
 
 @task
-@install_requirements(('cmake', 'libnuma-dev', 'libtool', 'm4', 'automake'))
+@install_requirements(('cmake', 'libnuma-dev', 'libtool', 'm4', 'automake', 'ccache'))
 def bootstrap_swan():
     run('mkdir -pp %s' % SWAN_HOME)
 
+    key, revisions = swan_toolchain_key() if SWAN_PREBUILT else (None, None)
+    if not (key and install_swan_toolchain(key)):
+        with CommandBatch('swan_sources') as batch, cd(SWAN_HOME):
+            batch.run("rm -f .swan-toolchain")
+            batch.run(git_checkout_command(SWAN_LLVM_REPO, 'llvm'))
+            batch.run(git_checkout_command(SWAN_CLANG_REPO, 'llvm/tools/clang'))
+            batch.run(git_checkout_command(SWAN_RT_REPO, 'swan_runtime'))
+        build_swan()
+        if key:
+            publish_swan_toolchain(key, revisions)
+
     with cd(SWAN_HOME):
-        if (not exists(os.path.join(SWAN_HOME, 'llvm'))):
-            run("git clone %s llvm" % SWAN_LLVM_REPO)
-        if (not exists(os.path.join(SWAN_HOME, 'llvm/tools/clang'))):
-            run("git clone %s llvm/tools/clang" % SWAN_CLANG_REPO)
-        run('mkdir -p build')
-        with cd('build'):
-            run('cmake -G "Unix Makefiles" ../llvm')
-            run('make clean')
-            run('make')
-        test_clang()
-        if (not exists(os.path.join(SWAN_HOME, 'swan_runtime'))):
-            run("git clone %s" % SWAN_RT_REPO)
-        with cd('swan_runtime'):
-            run("libtoolize")
-            run("aclocal")
-            run("automake --add-missing")
-            run("autoconf")
-            run("./configure --prefix=%s/swan_runtime/lib CC=../build/bin/clang CXX=../build/bin/clang++" % SWAN_HOME)
-            run("make clean")
-            run("make")
-        run("git clone https://github.com/project-asap/swan_tests.git")
+        git_checkout(SWAN_TESTS_REPO, 'swan_tests')
         with cd("swan_tests"):
             run("make CXX=../build/bin/clang++ SWANRTDIR=../swan_runtime test")
 
+def swan_toolchain_key():
+    # Upstream revisions are looked up from the machine running fab, all
+    # three at once; the key is None if any of them can't be resolved.
+    lookups = [subprocess.Popen(['git', 'ls-remote', repo, 'HEAD'], stdout=subprocess.PIPE)
+               for repo in (SWAN_LLVM_REPO, SWAN_CLANG_REPO, SWAN_RT_REPO)]
+    revisions = [lookup.communicate()[0].split()[:1] for lookup in lookups]
+    if not all(revisions) or any(lookup.returncode for lookup in lookups):
+        print('Could not resolve the Swan revisions, building from source')
+        return None, None
+    revisions = [revision[0] for revision in revisions]
+
+    with settings(hide('everything')):
+        platform = run('uname -m && (. /etc/os-release && echo $ID $VERSION_ID)')
+    return _build_stamp(platform.split(), revisions), revisions
+
+def install_swan_toolchain(key):
+    local_path = artifacts.cached_artifact('swan-toolchain/%s' % key)
+    if not local_path:
+        print('No prebuilt Swan toolchain %s in the cache' % key)
+        return False
+
+    with settings(hide('everything'), warn_only=True):
+        installed = run('cat %s/.swan-toolchain' % SWAN_HOME).strip()
+    if installed == key:
+        print('Swan toolchain %s is already installed on %s' % (key, env.host))
+        return True
+
+    archive = os.path.join(SWAN_HOME, 'swan-toolchain.tar.gz')
+    artifacts.distribute_file(local_path, archive, hosts=[env.host_string])
+    with CommandBatch('swan_toolchain') as batch, cd(SWAN_HOME):
+        batch.run('tar -xzf %s' % archive)
+        batch.run('rm %s' % archive)
+        batch.run('echo %s > .swan-toolchain' % key)
+    return True
+
+def publish_swan_toolchain(key, revisions):
+    # Existing checkouts aren't updated, so they may not be at the
+    # upstream revisions the key was computed from.
+    with cd(SWAN_HOME), settings(hide('everything'), warn_only=True):
+        built = run('for d in llvm llvm/tools/clang swan_runtime; do '
+                    '(cd $d && git rev-parse HEAD); done').split()
+    if built != revisions:
+        print('Not publishing the Swan toolchain of %s: its checkouts are not at the '
+              'upstream revisions' % env.host)
+        return
+
+    archive = '/tmp/swan-toolchain-%s.tar.gz' % key
+    with cd(SWAN_HOME):
+        run('tar -czf %s --exclude=.git %s' % (archive, ' '.join(SWAN_TOOLCHAIN_PATHS)))
+        download_path = artifacts.download_path()
+        get(archive, download_path)
+        run('rm %s' % archive)
+        run('echo %s > .swan-toolchain' % key)
+    artifacts.publish_artifact('swan-toolchain/%s' % key, download_path)
+    print('Published Swan toolchain %s' % key)
+
 @task
-@uninstall_requirements(('cmake', 'libnuma-dev', 'libtool', 'automake'))
+def build_swan():
+    # LLVM and Clang are built out of tree, in build/, while the runtime is
+    # built in its source tree, which is where swan_tests expects it.
+    with cd(SWAN_HOME):
+        probes = run_probes({
+            'cores': 'nproc',
+            'llvm': _source_state_command('llvm'),
+            'clang': _source_state_command('llvm/tools/clang'),
+            'runtime': _source_state_command('swan_runtime'),
+            'llvm_stamp': 'cat build/.swan-build-stamp',
+            'runtime_stamp': 'cat swan_runtime/.swan-build-stamp',
+        })
+    jobs = SWAN_BUILD_JOBS or int(probes['cores'][1] or 1)
+    llvm_stamp = _build_stamp(probes['llvm'][1], probes['clang'][1], SWAN_USE_CCACHE)
+    runtime_stamp = _build_stamp(probes['runtime'][1], llvm_stamp, SWAN_USE_CCACHE)
+    llvm_rebuilt = probes['llvm_stamp'][1] != llvm_stamp
+
+    if llvm_rebuilt:
+        # cmake only runs again when there is no cache yet or the compiler
+        # launcher changed, so that SWAN_USE_CCACHE applies to existing builds
+        launcher = 'ccache' if SWAN_USE_CCACHE else ''
+        with CommandBatch('swan_llvm') as batch, cd(SWAN_HOME):
+            batch.run('mkdir -p build')
+            with cd('build'):
+                batch.run("grep -qx 'CMAKE_CXX_COMPILER_LAUNCHER:STRING=%(launcher)s' CMakeCache.txt || "
+                          'cmake -G "Unix Makefiles" -DCMAKE_C_COMPILER_LAUNCHER:STRING=%(launcher)s '
+                          '-DCMAKE_CXX_COMPILER_LAUNCHER:STRING=%(launcher)s ../llvm' %
+                          {'launcher': launcher})
+                batch.run('make -j%d' % jobs)
+                batch.run('echo %s > .swan-build-stamp' % llvm_stamp)
+        _record_build_time(SWAN_BUILD_LOG, 'llvm', batch.results, stamp=llvm_stamp,
+                           jobs=jobs, ccache=SWAN_USE_CCACHE)
+        test_clang()
+    else:
+        print('LLVM/Clang are up to date on %s' % env.host)
+        _record_build_time(SWAN_BUILD_LOG, 'llvm', None, stamp=llvm_stamp,
+                           jobs=jobs, ccache=SWAN_USE_CCACHE)
+
+    if llvm_rebuilt or probes['runtime_stamp'][1] != runtime_stamp:
+        compiler = '../build/bin/clang'
+        if SWAN_USE_CCACHE:
+            compiler = 'ccache %s' % compiler
+        with CommandBatch('swan_runtime') as batch, cd(os.path.join(SWAN_HOME, 'swan_runtime')):
+            batch.run("libtoolize")
+            batch.run("aclocal")
+            batch.run("automake --add-missing")
+            batch.run("autoconf")
+            batch.run("./configure --prefix=%s/swan_runtime/lib CC='%s' CXX='%s++'" %
+                      (SWAN_HOME, compiler, compiler))
+            if llvm_rebuilt:
+                # make can't tell that the compiler itself changed
+                batch.run("make clean")
+            batch.run("make -j%d" % jobs)
+            batch.run("echo %s > .swan-build-stamp" % runtime_stamp)
+        _record_build_time(SWAN_BUILD_LOG, 'swan_runtime', batch.results,
+                           stamp=runtime_stamp, jobs=jobs, ccache=SWAN_USE_CCACHE)
+    else:
+        print('swan_runtime is up to date on %s' % env.host)
+        _record_build_time(SWAN_BUILD_LOG, 'swan_runtime', None,
+                           stamp=runtime_stamp, jobs=jobs, ccache=SWAN_USE_CCACHE)
+
+def _source_state_command(source_dir):
+    # The checked out revision plus a digest of any local modifications
+    return 'cd %s && git rev-parse HEAD && git diff HEAD | md5sum' % source_dir
+
+def _build_stamp(*inputs):
+    return hashlib.md5(json.dumps(inputs)).hexdigest()
+
+def _record_build_time(log_file, component, results, **details):
+    # results are those of a CommandBatch, or None if the build was skipped
+    details.update({
+        'time': time.time(),
+        'host': env.host,
+        'component': component,
+        'skipped': results is None,
+        'seconds': sum(result[3] for result in results or ()),
+        'steps': dict((command, duration) for _, command, _, duration in results or ()),
+    })
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(details) + '\n')
+
+@task
+@uninstall_requirements(('cmake', 'libnuma-dev', 'libtool', 'automake', 'ccache'))
 def remove_swan():
     run("rm -rf %s" % SWAN_HOME)
 
+# Components installed by bootstrap, as (name, prerequisites, function).
+# Every stage starts as soon as all of its prerequisites have finished.
+BOOTSTRAP_STAGES = [
+    ('postgres', (), bootstrap_postgres),
+    ('wmt', (), bootstrap_wmt),
+    ('IReS', (), bootstrap_IReS),
+    ('spark_forth', (), lambda: execute(bootstrap_spark_forth)),
+    # Both Spark distributions use the same master port and each one stops
+    # the other when started, so they must not be set up at the same time.
+    ('spark', ('spark_forth',), lambda: execute(bootstrap_spark)),
+    ('swan', (), bootstrap_swan),
+#    ('operators', (), bootstrap_operators),
+#    ('telecom_analytics', (), bootstrap_telecom_analytics),
+#    ('web_analytics', (), bootstrap_web_analytics),
+]
+
+# Pass report=<file> to save the stage timings and critical path as JSON.
 @task
-def bootstrap():
-
+def bootstrap(report=None):
     if not exists(ASAP_HOME):
         run("mkdir -p %s" % ASAP_HOME)
-    bootstrap_postgres
-    bootstrap_wmt()
-    bootstrap_IReS()
-    execute(bootstrap_spark_forth)
-    execute(bootstrap_spark)
-    bootstrap_swan()
-#    bootstrap_operators()
-#    bootstrap_telecom_analytics()
-#    bootstrap_web_analytics()
+    run_stage_graph(BOOTSTRAP_STAGES, report)
+
+def run_stage_graph(stages, report=None):
+    prerequisites = dict((name, set(deps)) for name, deps, _ in stages)
+    functions = dict((name, function) for name, _, function in stages)
+    for name, deps in prerequisites.items():
+        if not deps <= set(functions):
+            abort('Stage %s depends on unknown stages %s' %
+                  (name, ', '.join(sorted(deps - set(functions)))))
+
+    started = time.time()
+    pending = [name for name, _, _ in stages]
+    running = {}
+    timings = {}
+    failed = []
+    while pending or running:
+        done = set(name for name in timings if name not in failed)
+        for name in list(pending):
+            if not failed and prerequisites[name] <= done:
+                process = multiprocessing.Process(target=_run_stage,
+                                                  args=(functions[name],), name=name)
+                process.start()
+                running[name] = (process, time.time() - started)
+                pending.remove(name)
+        if not running:
+            break
+        time.sleep(0.2)
+        for name, (process, start) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[name]
+                timings[name] = (start, time.time() - started)
+                if process.exitcode != 0:
+                    failed.append(name)
+
+    path = critical_path(prerequisites, timings)
+    print_stage_report(stages, timings, failed, path)
+    if report:
+        with open(report, 'w') as f:
+            json.dump({
+                'wall_time': time.time() - started,
+                'critical_path': path,
+                'stages': dict((name, {
+                    'prerequisites': sorted(prerequisites[name]),
+                    'start': start,
+                    'end': end,
+                    'duration': end - start,
+                    'failed': name in failed,
+                }) for name, (start, end) in timings.items()),
+            }, f, indent=2)
+
+    if failed:
+        abort('Stages failed: %s' % ', '.join(failed))
+    if pending:
+        abort('Stages never became runnable (dependency cycle?): %s' % ', '.join(pending))
+
+def _run_stage(function):
+    # Stages run in forked processes which, just like fabric's @parallel
+    # tasks, must open their own connections instead of sharing the parent's.
+    connections.clear()
+    function()
+
+def critical_path(prerequisites, timings):
+    # Walk back from the last stage to finish through the prerequisite that
+    # held it up the longest.
+    if not timings:
+        return []
+    name = max(timings, key=lambda n: timings[n][1])
+    path = [name]
+    while prerequisites[name]:
+        name = max(prerequisites[name], key=lambda n: timings[n][1])
+        path.append(name)
+    return list(reversed(path))
+
+def print_stage_report(stages, timings, failed, path):
+    print('Bootstrap stages:')
+    for name, _, _ in stages:
+        if name not in timings:
+            print('  %-15s not run' % name)
+            continue
+        start, end = timings[name]
+        print('  %-15s start %8.1fs  duration %8.1fs%s' %
+              (name, start, end - start, '  FAILED' if name in failed else ''))
+    if path:
+        print('Critical path: %s (%.1fs)' % (' -> '.join(path), timings[path[-1]][1]))
 
 
 @task
@@ -556,7 +1110,7 @@ def remove_IReS():
 @parallel
 @roles('spark_nodes')
 def remove_spark_forth():
-    if env.host == SPARK_MASTER:
+    if env.host == spark_master():
         stop_spark_forth()
     run("rm -rf %s" % SPARK_FORTH_HOME)
     run("rm -rf %s" % SPARK_FORTH_TESTS_HOME)
@@ -565,7 +1119,7 @@ def remove_spark_forth():
 @parallel
 @roles('spark_nodes')
 def remove_spark():
-    if env.host == SPARK_MASTER:
+    if env.host == spark_master():
         stop_spark()
     run("rm -rf %s" % SPARK_HOME)
 
@@ -579,3 +1133,9 @@ def remove():
     remove_postgres()
 
     #run("rm -rf %s" % ASAP_HOME)
+
+@task
+@runs_once
+def benchmark_startup(count=5):
+    """Time how long fab takes to load this fabfile and list its tasks"""
+    tracing.benchmark_startup(__file__, count)
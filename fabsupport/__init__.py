@@ -0,0 +1,5 @@
+"""Helpers shared by the fabfiles of this repository.
+
+The fabfiles in the subdirectories add the repository root to sys.path
+before importing them.
+"""
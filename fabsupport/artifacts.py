@@ -0,0 +1,234 @@
+"""Download packages once and relay them from node to node.
+
+Packages are downloaded only once, into CACHE_DIR on the machine running
+fab, and uploaded to a single node. From there they are relayed over HTTP:
+every round, each node holding a file serves it to one node that doesn't,
+so the mirror serves a single copy per rollout and the number of holders
+doubles every round.
+
+A node only serves a private temporary directory holding a link to (or a
+copy of) the file, on RELAY_PORT of the address fab reached it on, and
+only while the file is being relayed.
+
+Set FABRIC_ARTIFACT_CACHE or FABRIC_ARTIFACT_RELAY_PORT to override
+CACHE_DIR or RELAY_PORT for a run.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import urllib2
+
+from fabric.api import env, execute, hide, parallel, put, run, settings
+from fabric.utils import abort
+
+CACHE_DIR = os.environ.get('FABRIC_ARTIFACT_CACHE') or \
+    os.path.expanduser('~/.cache/fabric-artifacts')
+RELAY_PORT = int(os.environ.get('FABRIC_ARTIFACT_RELAY_PORT') or 8919)
+
+_distributed = set()
+
+# Prints "<address> <directory>" once the file is linked into the directory
+# and the server, started in the background with its pid in <directory>/pid,
+# answers for a token file only it serves. Otherwise (e.g. the port is taken
+# by another server) it cleans up and exits with status 1. Python 2 has no
+# way to bind SimpleHTTPServer to an address from the command line; python 3
+# is used on distros that no longer ship python 2.
+_SERVE_SCRIPT = """\
+dir=$(mktemp -d %(parent)s/.relay.XXXXXX) && mkdir $dir/files && \
+{ ln %(file)s $dir/files/ 2> /dev/null || cp %(file)s $dir/files/; } || exit 1
+token=.$(basename $dir) && touch $dir/files/$token
+addr=$(echo $SSH_CONNECTION | cut -d ' ' -f 3)
+case "$addr" in ""|*:*) addr=$(hostname -I | cut -d ' ' -f 1);; esac
+cd $dir/files && if python -c 'import SimpleHTTPServer' 2> /dev/null; then \
+exec nohup python -c 'import sys, BaseHTTPServer as B, SimpleHTTPServer as S; \
+B.HTTPServer((sys.argv[1], int(sys.argv[2])), S.SimpleHTTPRequestHandler).serve_forever()' \
+$addr %(port)d; else exec nohup python3 -m http.server --bind $addr %(port)d; fi \
+> /dev/null 2>&1 < /dev/null &
+echo $! > $dir/pid
+for i in $(seq 50); do
+    wget -q --no-proxy -O /dev/null http://$addr:%(port)d/$token && { echo "$addr $dir"; exit 0; }
+    kill -0 $(cat $dir/pid) 2> /dev/null || break
+    sleep 0.1
+done
+kill $(cat $dir/pid) 2> /dev/null; rm -rf $dir
+exit 1"""
+
+
+def distribute_artifact(url, remote_path, sha256=None, hosts=None):
+    """Download url, unless cached, and relay it to remote_path on hosts
+    (all hosts of the task if None). Done once per run for each url and
+    remote_path."""
+    if (url, remote_path) in _distributed:
+        return
+    local_path = cache_artifact(url, sha256)
+    distribute_file(local_path, remote_path, hosts, os.path.basename(local_path))
+    _distributed.add((url, remote_path))
+
+
+def cache_artifact(url, sha256=None):
+    """Return the path of the cached download of url, downloading it first
+    if needed. The download must match sha256, if given."""
+    # Cached files are named after their checksum, so a known checksum is
+    # enough to find them even if they were downloaded from another URL.
+    digest = sha256 or _read_index().get(url)
+    if digest and os.path.isfile(os.path.join(CACHE_DIR, digest)):
+        return os.path.join(CACHE_DIR, digest)
+
+    print('Downloading %s' % url)
+    path = download_path()
+    source = urllib2.urlopen(url)
+    try:
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+    finally:
+        source.close()
+
+    digest = file_sha256(path)
+    if sha256 and digest != sha256:
+        os.remove(path)
+        abort('Checksum mismatch for %s: expected %s, got %s' % (url, sha256, digest))
+    return publish_artifact(url, path, digest)
+
+
+def cached_artifact(name):
+    """Return the path of the file published as name, or None."""
+    digest = _read_index().get(name)
+    if digest and os.path.isfile(os.path.join(CACHE_DIR, digest)):
+        return os.path.join(CACHE_DIR, digest)
+    return None
+
+
+def publish_artifact(name, path, digest=None):
+    """Move path into the cache, where it can be found by name from then on."""
+    digest = digest or file_sha256(path)
+    local_path = os.path.join(CACHE_DIR, digest)
+    os.rename(path, local_path)
+    index = _read_index()
+    index[name] = digest
+    with open(os.path.join(CACHE_DIR, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return local_path
+
+
+def download_path():
+    """A path in the cache to download a file to before publishing it."""
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    return os.path.join(CACHE_DIR, 'download.%d' % os.getpid())
+
+
+def _read_index():
+    index_file = os.path.join(CACHE_DIR, 'index.json')
+    if not os.path.isfile(index_file):
+        return {}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def distribute_file(local_path, remote_path, hosts=None, digest=None):
+    """Put local_path at remote_path on hosts (all hosts of the task if
+    None), skipping those that already have it. Without a local_path, the
+    file (with the given digest) must already be on one of the hosts."""
+    hosts = hosts if hosts is not None else env.all_hosts or env.hosts
+    if not hosts:
+        return
+    digest = digest or file_sha256(local_path)
+
+    remote_digests = execute(_remote_sha256, remote_path, hosts=hosts)
+    holders = [host for host in hosts if remote_digests[host] == digest]
+    missing = [host for host in hosts if host not in holders]
+    transfers = []
+
+    if missing and not holders:
+        if not local_path:
+            abort('None of the hosts has %s to distribute' % remote_path)
+        size = os.path.getsize(local_path)
+        seed = missing.pop(0)
+        execute(_seed_file, local_path, remote_path, hosts=[seed])
+        transfers.append(('local', seed, size))
+        holders.append(seed)
+
+    # host -> (address, directory) of the nodes serving the file
+    servers = {}
+    try:
+        while missing:
+            new_servers = execute(_serve_file, remote_path,
+                                  hosts=[host for host in holders if host not in servers])
+            servers.update((host, server) for host, server in new_servers.items() if server)
+            failed = sorted(host for host, server in new_servers.items() if not server)
+            if failed:
+                abort('Could not serve %s on port %d of %s; is the port already in use?' %
+                      (remote_path, RELAY_PORT, ', '.join(failed)))
+
+            sources = dict(zip(missing, holders))
+            addresses = dict((host, servers[source][0]) for host, source in sources.items())
+            results = execute(_relay_file, remote_path, addresses, hosts=list(sources))
+            for host, (received_size, received_digest) in results.items():
+                if received_digest != digest:
+                    abort('Checksum mismatch for %s relayed from %s to %s' %
+                          (remote_path, sources[host], host))
+                transfers.append((sources[host], host, received_size))
+
+            holders.extend(missing[:len(sources)])
+            missing = missing[len(sources):]
+    finally:
+        if servers:
+            execute(_stop_serving_file, servers, hosts=list(servers))
+
+    print('Transfers of %s:' % os.path.basename(remote_path))
+    for source, target, transferred in transfers:
+        print('  %-30s -> %-30s %12d bytes' % (source, target, transferred))
+    print('  %d bytes uploaded from the local cache, %d nodes already up to date' %
+          (sum(t for source, _, t in transfers if source == 'local'),
+           len(hosts) - len(transfers)))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@parallel
+def _remote_sha256(remote_path):
+    with settings(hide('everything'), warn_only=True):
+        return run("sha256sum %s 2>/dev/null | cut -d ' ' -f 1" % remote_path).strip()
+
+
+def _seed_file(local_path, remote_path):
+    run('mkdir -p %s' % (os.path.dirname(remote_path) or '.'))
+    put(local_path, remote_path)
+
+
+@parallel
+def _serve_file(remote_path):
+    # None if the server could not be started
+    with settings(hide('warnings'), warn_only=True):
+        output = run(_SERVE_SCRIPT % {'parent': os.path.dirname(remote_path) or '.',
+                                      'file': remote_path, 'port': RELAY_PORT}, pty=False)
+    if output.failed:
+        return None
+    address, directory = output.splitlines()[-1].split()
+    return address, directory
+
+
+@parallel
+def _stop_serving_file(servers):
+    directory = servers[env.host_string][1]
+    with settings(warn_only=True):
+        run('kill $(cat %(dir)s/pid) 2> /dev/null; rm -rf %(dir)s' % {'dir': directory})
+
+
+@parallel
+def _relay_file(remote_path, addresses):
+    url = 'http://%s:%d/%s' % (addresses[env.host_string], RELAY_PORT, os.path.basename(remote_path))
+    output = run("mkdir -p %(dir)s && "
+                 "wget -q --tries=10 --waitretry=1 --retry-connrefused -O %(file)s %(url)s && "
+                 "stat -c %%s %(file)s && sha256sum %(file)s | cut -d ' ' -f 1" %
+                 {'dir': os.path.dirname(remote_path) or '.', 'file': remote_path, 'url': url})
+    received_size, received_digest = output.split()
+    return int(received_size), received_digest
@@ -0,0 +1,106 @@
+"""Run a sequence of shell steps in as few remote commands as possible."""
+
+import re
+import time
+import pipes
+import itertools
+
+import fabric.operations
+from fabric.api import hide, run, settings, sudo
+from fabric.utils import error
+
+from fabsupport import tracing
+
+
+class CommandBatch(object):
+    """Collects shell steps and runs them in as few remote commands as
+    possible, stopping at the first step that fails:
+
+        with CommandBatch('swan_runtime') as batch:
+            batch.run('./configure')
+            batch.run('make')
+            batch.sudo('make install')
+
+    Consecutive run (or sudo) steps are sent as a single script; each step
+    keeps the cd/shell_env context it was added in. The exit code and
+    duration of every step are printed and recorded in the trace, and a
+    failing step is reported like a failing run() would be.
+    """
+
+    STEP_END = re.compile(r'^<== \[.* (\d+)/\d+\] exit (\d+) after (\d+) ms$')
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def run(self, command):
+        self._add(command, False)
+
+    def sudo(self, command):
+        self._add(command, True)
+
+    def _add(self, command, use_sudo):
+        # The same prefixes fabric.operations._run_command would apply
+        prefixed = fabric.operations._prefix_env_vars(
+            fabric.operations._prefix_commands(command, 'remote'))
+        self.steps.append((len(self.steps) + 1, command, prefixed, use_sudo))
+
+    def execute(self):
+        steps, self.steps = self.steps, []
+        for use_sudo, group in itertools.groupby(steps, lambda step: step[3]):
+            output = self._run_group(list(group), use_sudo, len(steps))
+            if output.failed:
+                break
+
+        if self.results:
+            print('%s steps:' % self.name)
+            for number, command, exit_code, duration in self.results:
+                print('  %2d/%d %8.1fs %s%s' % (number, len(steps), duration, command,
+                                                '  FAILED (%d)' % exit_code if exit_code else ''))
+        if steps and output.failed:
+            failed = [result for result in self.results if result[2]]
+            if failed:
+                number, command, exit_code, _ = failed[-1]
+                error('Step %d/%d of %s failed with exit code %d: %s' %
+                      (number, len(steps), self.name, exit_code, command))
+            else:
+                error('%s stopped with exit code %d before finishing its steps' %
+                      (self.name, output.return_code))
+        return self.results
+
+    def _run_group(self, group, use_sudo, total):
+        script = []
+        for number, command, prefixed, _ in group:
+            label = '[%s %d/%d]' % (self.name, number, total)
+            script.append('echo %s; t=$(date +%%s%%N); (%s); s=$?; '
+                          'echo "<== %s exit $s after $(( ($(date +%%s%%N) - t) / 1000000 )) ms"; '
+                          '[ $s -eq 0 ] || exit $s' %
+                          (pipes.quote('==> %s %s' % (label, command)), prefixed, label))
+
+        started = time.time()
+        with settings(hide('warnings'), cwd='', path='', shell_env={}, command_prefixes=[],
+                      warn_only=True):
+            output = (sudo if use_sudo else run)('\n'.join(script))
+
+        commands = dict((number, command) for number, command, _, _ in group)
+        offset = started
+        for line in output.splitlines():
+            match = self.STEP_END.match(line.strip())
+            if not match or int(match.group(1)) not in commands:
+                continue
+            number, exit_code = int(match.group(1)), int(match.group(2))
+            duration = int(match.group(3)) / 1000.0
+            self.results.append((number, commands[number], exit_code, duration))
+            tracing.record_event({'kind': 'step', 'name': commands[number], 'step': self.name,
+                                  'start': offset, 'duration': duration,
+                                  'status': 'failed' if exit_code else 'ok', 'exit': exit_code})
+            offset += duration
+        return output
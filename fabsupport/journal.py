@@ -0,0 +1,52 @@
+"""Skip install steps that already completed with the same inputs.
+
+Completed steps are appended to a journal file on each host together with
+a fingerprint of their inputs and arguments. A step whose fingerprint is
+already in the journal is skipped, unless fab runs with
+--set ignore_journal=1.
+"""
+
+import json
+import hashlib
+import functools
+
+from fabric.api import env, hide, run, settings
+
+# (journal file, host) -> {step: fingerprint}
+_journals = {}
+
+
+def journaled_step(journal_file, get_inputs):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Private helpers are journaled under their public name
+            step = func.__name__.lstrip('_')
+            fingerprint = hashlib.md5(json.dumps([get_inputs(), args, kwargs],
+                sort_keys=True, default=str).encode('utf-8')).hexdigest()
+            if not env.get('ignore_journal') and \
+                    read_journal(journal_file).get(step) == fingerprint:
+                print('%s is up to date on %s' % (step, env.host))
+                return None
+            result = func(*args, **kwargs)
+            run("echo '%s %s' >> %s" % (step, fingerprint, journal_file))
+            read_journal(journal_file)[step] = fingerprint
+            return result
+        return wrapper
+    return decorator
+
+
+def read_journal(journal_file):
+    # Read once per host; later entries for a step override earlier ones.
+    key = (journal_file, env.host)
+    if key not in _journals:
+        with settings(hide('everything'), warn_only=True):
+            output = run('cat %s 2>/dev/null' % journal_file)
+        _journals[key] = dict(line.split() for line in output.splitlines()
+                              if len(line.split()) == 2)
+    return _journals[key]
+
+
+def reset_journal(journal_file):
+    run('rm -f %s' % journal_file)
+    _journals.pop((journal_file, env.host), None)
@@ -0,0 +1,24 @@
+"""Run independent shell checks on a host in a single round trip."""
+
+from fabric.api import hide, run, settings
+
+
+def run_probes(probes):
+    """Run probes, {name: command}, in one remote command and return
+    {name: (exit code, output)}."""
+    script = ''.join("echo '@@probe %s'; (%s) 2>&1; printf '\\n@@exit %%d\\n' $?; " %
+                     (name, command) for name, command in probes.items())
+    with settings(hide('everything'), warn_only=True):
+        output = run(script)
+
+    results = {}
+    name, lines = None, []
+    for line in output.splitlines():
+        if line.startswith('@@probe '):
+            name, lines = line[len('@@probe '):], []
+        elif line.startswith('@@exit ') and name is not None:
+            results[name] = (int(line[len('@@exit '):]), '\n'.join(lines).rstrip('\n'))
+            name = None
+        elif name is not None:
+            lines.append(line)
+    return results
@@ -0,0 +1,206 @@
+"""Record every task run, remote command and upload, per host, and time
+how long fab takes to load a fabfile.
+
+Tracing is enabled by setting FABRIC_TRACE to the file to write the trace
+to. Events are appended to a file as they happen, since @parallel tasks and
+bootstrap stages run in forked processes, and gathered by the process
+running fab at exit: a summary is printed and a Chrome trace-event file,
+for chrome://tracing or ui.perfetto.dev, is written to FABRIC_TRACE.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import subprocess
+
+import fabric.operations
+import fabric.sftp
+import fabric.tasks
+from fabric.api import env
+
+_trace_file = None
+_trace_pid = None
+_events_file = None
+_fabfile_globals = None
+_running_tasks = []
+
+
+def install(fabfile_globals):
+    """Trace this fab run to $FABRIC_TRACE, if set.
+
+    The step of a remote operation is the innermost function, of the fabfile
+    whose globals are given or of another fabsupport module, that led to it.
+    """
+    global _trace_file, _trace_pid, _events_file, _fabfile_globals
+    trace_file = os.environ.get('FABRIC_TRACE')
+    if not trace_file or _trace_file:
+        return
+    _trace_file = trace_file
+    _trace_pid = os.getpid()
+    _events_file = os.path.abspath('%s.%d.events' % (trace_file, _trace_pid))
+    _fabfile_globals = fabfile_globals
+
+    fabric.tasks.WrappedCallableTask.run = _traced_task(fabric.tasks.WrappedCallableTask.run)
+    fabric.operations._run_command = _traced_command(fabric.operations._run_command)
+    fabric.sftp.SFTP.put = _traced_upload(fabric.sftp.SFTP.put)
+    atexit.register(_write_trace)
+
+
+def benchmark_startup(fabfile, count=5):
+    """Time how long fab takes to load fabfile and list its tasks, count
+    times, and print the fastest, median and slowest run."""
+    fabfile = os.path.splitext(os.path.abspath(fabfile))[0] + '.py'
+    command = [sys.executable, sys.argv[0], '-f', fabfile, '-l', '--abort-on-prompts']
+    timings = []
+    failures = 0
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(int(count)):
+            started = time.time()
+            if subprocess.call(command, stdout=devnull, stderr=devnull):
+                failures += 1
+            timings.append(time.time() - started)
+    timings.sort()
+    print('fab -l on %s, %d runs:' % (fabfile, len(timings)))
+    print('  %-8s %8.3fs' % ('min', timings[0]))
+    print('  %-8s %8.3fs' % ('median', timings[len(timings) // 2]))
+    print('  %-8s %8.3fs' % ('max', timings[-1]))
+    if failures:
+        print('  %d runs failed' % failures)
+
+
+def record_event(event):
+    """Record event (a dict with at least kind, name, start and duration)
+    for the current host and task. Does nothing unless tracing."""
+    if not _trace_file:
+        return
+    event.update(host=env.host or 'local', pid=os.getpid(),
+                 task=_running_tasks[-1] if _running_tasks else None)
+    with open(_events_file, 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+def _calling_step():
+    frame = sys._getframe(2)
+    while frame and not _is_step(frame):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame else None
+
+
+def _is_step(frame):
+    if frame.f_globals is _fabfile_globals:
+        return True
+    module = frame.f_globals.get('__name__', '')
+    return module.startswith('fabsupport.') and module != __name__
+
+
+def _upload_size(local_path):
+    if hasattr(local_path, 'getvalue'):
+        return len(local_path.getvalue())
+    if hasattr(local_path, 'fileno'):
+        return os.fstat(local_path.fileno()).st_size
+    return os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+
+
+def _traced_task(original):
+    @functools.wraps(original)
+    def run_task(self, *args, **kwargs):
+        _running_tasks.append(self.name)
+        started = time.time()
+        status = 'error'
+        try:
+            result = original(self, *args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            _running_tasks.pop()
+            record_event({'kind': 'task', 'name': self.name, 'start': started,
+                          'duration': time.time() - started, 'status': status})
+    return run_task
+
+
+def _traced_command(original):
+    @functools.wraps(original)
+    def run_command(command, *args, **kwargs):
+        started = time.time()
+        status, exit_code = 'error', None
+        try:
+            result = original(command, *args, **kwargs)
+            status = 'failed' if result.failed else 'ok'
+            exit_code = result.return_code
+            return result
+        finally:
+            record_event({'kind': 'sudo' if kwargs.get('sudo') else 'run', 'name': command,
+                          'step': _calling_step(), 'start': started,
+                          'duration': time.time() - started, 'status': status,
+                          'exit': exit_code})
+    return run_command
+
+
+def _traced_upload(original):
+    @functools.wraps(original)
+    def upload(self, local_path, remote_path, *args, **kwargs):
+        started = time.time()
+        status = 'error'
+        try:
+            result = original(self, local_path, remote_path, *args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            record_event({'kind': 'put', 'name': 'put %s' % remote_path,
+                          'step': _calling_step(), 'start': started,
+                          'duration': time.time() - started, 'status': status,
+                          'bytes': _upload_size(local_path)})
+    return upload
+
+
+def _write_trace():
+    if os.getpid() != _trace_pid or not os.path.isfile(_events_file):
+        return
+    with open(_events_file) as f:
+        events = [json.loads(line) for line in f]
+    os.remove(_events_file)
+
+    # One trace "process" per host and one "thread" per local process
+    hosts = sorted(set(event['host'] for event in events))
+    origin = min(event['start'] for event in events)
+    trace = [{'name': 'process_name', 'ph': 'M', 'pid': i, 'args': {'name': host}}
+             for i, host in enumerate(hosts)]
+    for event in events:
+        trace.append({
+            'name': event['name'][:120], 'cat': event['kind'], 'ph': 'X',
+            'ts': (event['start'] - origin) * 1e6, 'dur': event['duration'] * 1e6,
+            'pid': hosts.index(event['host']), 'tid': event['pid'],
+            'args': dict((key, event[key]) for key in ('task', 'step', 'status', 'exit', 'bytes')
+                         if event.get(key) is not None),
+        })
+    with open(_trace_file, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    _print_summary(events)
+    print('Trace written to %s' % _trace_file)
+
+
+def _print_summary(events):
+    rows = {}
+    for event in events:
+        task = event['name'] if event['kind'] == 'task' else event['task']
+        row = rows.setdefault((task or '-', event['host']),
+                              {'wall': 0, 'commands': 0, 'remote': 0, 'bytes': 0, 'failed': 0})
+        if event['kind'] == 'task':
+            row['wall'] += event['duration']
+        elif event['kind'] != 'step':
+            # Steps of a command batch ran within a command already counted
+            row['commands'] += 1
+            row['remote'] += event['duration']
+            row['bytes'] += event.get('bytes', 0)
+            row['failed'] += event['status'] != 'ok'
+    print('Tasks by wall time:')
+    print('  %-30s %-25s %9s %6s %9s %12s %6s' %
+          ('task', 'host', 'wall', 'cmds', 'in cmds', 'uploaded', 'failed'))
+    for (task, host), row in sorted(rows.items(), key=lambda item: -item[1]['wall']):
+        print('  %-30s %-25s %8.1fs %6d %8.1fs %12d %6d' %
+              (task, host, row['wall'], row['commands'], row['remote'], row['bytes'],
+               row['failed']))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Compares the streaming editor of replaceHadoopProperty.py with the former
+# ElementTree + minidom implementation on a generated configuration file.
+#
+#   ./benchmarkReplaceHadoopProperty.py [numProperties] [numEdits]
+#
+# Each implementation runs in its own process so that its peak memory use
+# can be reported.
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ElementTree
+import xml.dom.minidom as minidom
+
+import replaceHadoopProperty
+
+
+def generateConfiguration(fileName, numProperties):
+    with open(fileName, "w") as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write("<!-- Generated by benchmarkReplaceHadoopProperty.py -->\n")
+        f.write("<configuration>\n")
+        for i in range(numProperties):
+            f.write("  <property>\n"
+                    "    <name>benchmark.property.%d</name>\n"
+                    "    <value>value-%d</value>\n"
+                    "    <description>Generated property number %d.</description>\n"
+                    "  </property>\n" % (i, i, i))
+        f.write("</configuration>\n")
+
+
+def legacyReplace(fileName, properties):
+    # The implementation replaced by the streaming editor
+    propertyNames = list(properties.keys())
+    propertyValues = list(properties.values())
+    replaced = [False] * len(propertyNames)
+
+    tree = ElementTree.parse(fileName)
+    root = tree.getroot()
+
+    for prop in root.iter('property'):
+        children = dict((child.tag, child) for child in prop)
+        propertyName = children['name'].text.strip()
+        try:
+            index = propertyNames.index(propertyName)
+            children['value'].text = propertyValues[index]
+            replaced[index] = True
+        except Exception:
+            pass
+
+    for i, propertyReplaced in enumerate(replaced):
+        if not propertyReplaced:
+            newProperty = ElementTree.SubElement(root, "property")
+            ElementTree.SubElement(newProperty, "name").text = propertyNames[i]
+            ElementTree.SubElement(newProperty, "value").text = propertyValues[i]
+
+    rough_string = ElementTree.tostring(root, 'utf-8')
+    pretty = minidom.parseString(rough_string).toprettyxml(indent="\t")
+    prettyStr = "\n".join([line for line in pretty.split('\n') if line.strip() != ''])
+    fix = re.compile(r'((?<=>)(\n[\t]*)(?=[^<\t]))|(?<=[^>\t])(\n[\t]*)(?=<)')
+    with open(fileName, "w") as f:
+        f.write(re.sub(fix, '', prettyStr))
+
+
+def runImplementation(implementation, fileName, editsFile):
+    with open(editsFile) as f:
+        properties = replaceHadoopProperty.toProperties(
+            json.load(f, object_pairs_hook=replaceHadoopProperty.OrderedDict))
+
+    startTime = time.time()
+    if implementation == "legacy":
+        legacyReplace(fileName, properties)
+    else:
+        replaceHadoopProperty.replaceProperties(fileName, properties)
+    elapsed = time.time() - startTime
+
+    # ru_maxrss is in kilobytes on Linux
+    print("%f %d" % (elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main(argv):
+    if len(argv) == 5 and argv[1] == "--run":
+        runImplementation(*argv[2:])
+        return
+
+    numProperties = int(argv[1]) if len(argv) > 1 else 10000
+    numEdits = int(argv[2]) if len(argv) > 2 else 100
+
+    workDir = tempfile.mkdtemp()
+    try:
+        template = os.path.join(workDir, "template-site.xml")
+        generateConfiguration(template, numProperties)
+
+        # Change numEdits existing values and add ten new properties
+        step = max(1, numProperties // max(1, numEdits))
+        edits = dict(("benchmark.property.%d" % i, "changed-%d" % i)
+                     for i in range(0, numProperties, step)[:numEdits])
+        edits.update(("benchmark.added.%d" % i, "added") for i in range(10))
+        editsFile = os.path.join(workDir, "edits.json")
+        with open(editsFile, "w") as f:
+            json.dump(edits, f)
+
+        print("%d properties (%d bytes), %d edits" %
+              (numProperties, os.path.getsize(template), len(edits)))
+        for implementation in ("legacy", "streaming"):
+            fileName = os.path.join(workDir, "%s-site.xml" % implementation)
+            shutil.copy(template, fileName)
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                "--run", implementation, fileName, editsFile])
+            elapsed, maxRss = output.split()
+            print("  %-10s %8.3fs %8.1f MB peak RSS" %
+                  (implementation, float(elapsed), int(maxRss) / 1024.0))
+    finally:
+        shutil.rmtree(workDir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -9,9 +9,25 @@
 #   http://www.alexjf.net/blog/distributed-systems/hadoop-yarn-installation-definitive-guide
 
 import os
-from fabric.api import run, cd, env, settings, put, sudo
+import sys
+import json
+import math
+import time
+import fcntl
+import hashlib
+import StringIO
+import functools
+import fabric.tasks
+from fabric.api import run, cd, env, settings, put, sudo, hide
 from fabric.decorators import runs_once, parallel
+from fabric.network import normalize
 from fabric.tasks import execute
+from fabric.utils import abort
+import replaceHadoopProperty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fabsupport import artifacts, journal, tracing
+from fabsupport.probes import run_probes as _runProbes
 
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
@@ -40,6 +56,20 @@ AWS_ACCESSKEY_SECRET = os.getenv("AWS_ACCESSKEY_SECRET", "undefined")
 # automatically mounted, specify here the path to that device.
 EC2_INSTANCE_STORAGEDEV = None
 #EC2_INSTANCE_STORAGEDEV = "/dev/xvdb" For Ubuntu r3.xlarge instances
+# The discovered hosts and their tags are cached in this file. A cache older
+# than EC2_INVENTORY_TTL seconds is still used, while a background process
+# refreshes it for the next run, unless it is older than
+# EC2_INVENTORY_MAX_AGE seconds. Use refreshEC2Inventory to refresh it now.
+EC2_INVENTORY_FILE = os.path.expanduser("~/.cache/fabric-ec2-inventory.json")
+EC2_INVENTORY_TTL = 300
+EC2_INVENTORY_MAX_AGE = 24 * 3600
+# Instances are listed EC2_PAGE_SIZE (5 to 1000) at a time. Only those that
+# match EC2_FILTERS (as well as the Cluster tag) are part of the cluster.
+EC2_PAGE_SIZE = 500
+EC2_FILTERS = {"instance-state-name": "running"}
+# EC2 API endpoint to use instead of that of EC2_REGION, e.g. a local stub
+#EC2_ENDPOINT = "http://localhost:8773/"
+EC2_ENDPOINT = None
 
 
 #### Package Information ####
@@ -50,6 +80,8 @@ HADOOP_PACKAGE = "hadoop-%s" % HADOOP_VERSION
 HADOOP_PACKAGE_URL="https://dist.apache.org/repos/dist/release/hadoop/common/%s/%s.tar.gz" % (HADOOP_PACKAGE, HADOOP_PACKAGE)
 HADOOP_PREFIX = "%s/asap/%s" % (os.environ['HOME'], HADOOP_PACKAGE)
 HADOOP_CONF = os.path.join(HADOOP_PREFIX, "etc/hadoop")
+# If set, the downloaded package must have this sha256 checksum
+HADOOP_PACKAGE_SHA256 = None
 
 
 #### Installation information ####
@@ -100,6 +132,10 @@ ENVIRONMENT_FILE = "%s/.profile" % os.environ['HOME']
 # existing environment file? In any case, the previous version of the file
 # will be backed up.
 ENVIRONMENT_FILE_CLEAN = False
+# Should the variables be merged into the environment file by a single remote
+# command that atomically replaces the file? If False, each variable is
+# updated with its own grep and sed/echo commands.
+ENVIRONMENT_SINGLE_PASS = True
 ENVIRONMENT_VARIABLES = [
     ("JAVA_HOME", "/usr/lib/jvm/java-8-openjdk-amd64"), # Debian/Ubuntu 64 bits
     #("JAVA_HOME", "/usr/lib/jvm/java-7-openjdk"), # Arch Linux
@@ -117,8 +153,27 @@ ENVIRONMENT_VARIABLES = [
 ]
 
 
+#### Execution ####
+# Cluster-wide tasks run on all hosts in parallel, at most env.pool_size of
+# them at a time (fab -z). Set this (or fab --set rolling_batch_size=N) to
+# roll tasks over the cluster in consecutive batches of N hosts instead.
+ROLLING_BATCH_SIZE = None
+
+
+#### State journal ####
+# Completed steps are recorded on each host together with a fingerprint of
+# their inputs (versions, URLs, configuration values). Steps whose inputs
+# haven't changed since are skipped on later runs. Use resetJournal, or
+# fab --set ignore_journal=1, to redo them anyway.
+STATE_JOURNAL = "~/.hadoop-yarn-journal"
+
+
 #### Host data (for non-EC2 deployments) ####
 HOSTS_FILE="/etc/hosts"
+# Should the cluster hosts be written as a single hash-tagged block of
+# HOSTS_FILE, replaced by one remote command (and left alone when the hash
+# matches)? If False, each entry is updated with its own grep and sed/echo.
+HOSTS_MANAGED_BLOCK = True
 NET_INTERFACE="eth0"
 #RESOURCEMANAGER_HOST = "resourcemanager.alexjf.net"
 RESOURCEMANAGER_HOST = "localhost"
@@ -142,6 +197,26 @@ JOBHISTORY_HOST = JOBTRACKER_HOST
 JOBHISTORY_PORT = 10020
 
 
+#### Daemons ####
+# Daemons are started in this order (and stopped in the reverse one), each
+# on all of its hosts before moving on to the next.
+DAEMON_START_ORDER = ["namenode", "datanode", "resourcemanager", "nodemanager", "historyserver"]
+# Daemon -> (control script, Java class listed by jps, port it listens on
+# once ready). Adjust the ports if you override them in the site files.
+HADOOP_DAEMONS = {
+    "namenode": ("hadoop-daemon.sh", "NameNode", 8020),
+    "datanode": ("hadoop-daemon.sh", "DataNode", 50010),
+    "resourcemanager": ("yarn-daemon.sh", "ResourceManager", 8032),
+    "nodemanager": ("yarn-daemon.sh", "NodeManager", 8042),
+    "historyserver": ("mr-jobhistory-daemon.sh", "JobHistoryServer", JOBHISTORY_PORT),
+}
+WORKER_DAEMONS = ["datanode", "nodemanager"]
+# Seconds to wait for a daemon to be running and listening after starting it
+DAEMON_READY_TIMEOUT = 120
+# Number of workers restarted at a time by rollingRestart
+ROLLING_RESTART_BATCH_SIZE = 1
+
+
 #### Configuration ####
 # Should the configuration options be applied to a clean (empty) configuration
 # file or should they simply be merged (only additions and updates) into the
@@ -149,6 +224,32 @@ JOBHISTORY_PORT = 10020
 # will be backed up.
 CONFIGURATION_FILES_CLEAN = False
 
+# Should all the site files be sent to each host in a single payload and be
+# rewritten by a single replaceHadoopProperty.py process? If False, each
+# file is backed up and rewritten with separate remote commands.
+CONFIGURATION_BATCHED = True
+
+# Should YARN and MapReduce be sized from the hardware (cores, memory and
+# disks) of the slaves instead of with the fixed values below? See
+# _sizeResources for the formula. fab --set auto_size_resources=1 enables it
+# for a single run, and autoSizeResources only prints what it would set.
+AUTO_SIZE_RESOURCES = False
+# Containers per disk allowed by the formula (the HDP guide's value for
+# spinning disks). Set to None to ignore the number of disks, e.g. on SSDs.
+AUTO_SIZE_CONTAINERS_PER_DISK = 1.8
+# Fraction of a container given to the JVM heap of its task
+AUTO_SIZE_HEAP_RATIO = 0.8
+# Virtual memory (MB) a JVM reserves beyond its heap (compressed class
+# space, code cache, thread stacks), used to size vmem-pmem-ratio
+AUTO_SIZE_JVM_VMEM_OVERHEAD = 1536
+
+# Values for single hosts, {host: {fileName: {property: value}}}, merged over
+# those below and the auto-sized ones, e.g. for slaves with more memory:
+#HOST_SITE_OVERRIDES = {
+    #"slave1.alexjf.net": {"yarn-site.xml": {"yarn.nodemanager.resource.memory-mb": 57344}},
+#}
+HOST_SITE_OVERRIDES = {}
+
 #HADOOP_TEMP = "/mnt/hadoop/tmp"
 HADOOP_TEMP = "/mnt/hadoop/tmp"
 #HDFS_DATA_DIR = "/mnt/hdfs/datanode"
@@ -158,6 +259,20 @@ HDFS_NAME_DIR = "%s/asap/hdfs/namenode" % os.environ['HOME']
 
 IMPORTANT_DIRS = [HADOOP_TEMP, HDFS_DATA_DIR, HDFS_NAME_DIR]
 
+# Should every local disk without partitions, filesystem or mount point be
+# formatted and mounted (in parallel, and in /etc/fstab) as
+# DATA_DISK_PREFIX0, DATA_DISK_PREFIX1, ...? HDFS blocks and YARN local and
+# log dirs are then spread over all of those disks, and hadoop.tmp.dir
+# (which takes a single path) is put on the first one. Use setupDataDisks
+# on running clusters and then reconfigure.
+MULTI_DISK_LAYOUT = False
+DATA_DISK_PREFIX = "/data"
+DATA_DISK_FILESYSTEM = "ext4"
+# Data disks need no access times, nor root-reserved blocks, and shouldn't
+# keep a node from booting when they fail
+DATA_DISK_MKFS_OPTIONS = "-q -m 0 -E lazy_itable_init=1,lazy_journal_init=1"
+DATA_DISK_MOUNT_OPTIONS = "defaults,noatime,nofail"
+
 # Need to do this in a function so that we can rewrite the values when any
 # of the hosts change in runtime (e.g. EC2 node discovery).
 def updateHadoopSiteValues():
@@ -215,7 +330,14 @@ HDFS_SITE_VALUES = {}
 YARN_SITE_VALUES = {}
 MAPRED_SITE_VALUES = {}
 
+FABRIC_BOOTSTRAPPED = False
+
 def bootstrapFabric():
+    global FABRIC_BOOTSTRAPPED
+    if FABRIC_BOOTSTRAPPED:
+        return
+    FABRIC_BOOTSTRAPPED = True
+
     if EC2:
         readHostsFromEC2()
 
@@ -226,7 +348,9 @@ def bootstrapFabric():
     seen = set()
     # Remove empty hosts and duplicates
     cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
-    env.hosts = cleanedHosts
+    # Hosts or roles given with -H/-R take precedence over the cluster
+    if not env.hosts and not env.roles:
+        env.hosts = cleanedHosts
 
     if JOBTRACKER_HOST:
         MAPRED_SITE_VALUES["mapreduce.jobtracker.address"] = "%s:%s" % \
@@ -237,13 +361,312 @@ def bootstrapFabric():
             (JOBHISTORY_HOST, JOBHISTORY_PORT)
 
 
+def _needsCluster(func):
+    # The cluster (and EC2 inventory) is only looked at by the tasks that
+    # need it, so that listing tasks costs nothing. fab found no hosts for
+    # such a task when invoked without -H or -R, so it is then run again on
+    # the hosts of the cluster.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if FABRIC_BOOTSTRAPPED:
+            return func(*args, **kwargs)
+        bootstrapFabric()
+        if env.host_string or not env.hosts:
+            return func(*args, **kwargs)
+        execute(wrapper, *args, hosts=env.hosts, **kwargs)
+    return wrapper
+
+
+tracing.install(globals())
+
+
+# EXECUTION
+def _orchestrator(func):
+    # fab invokes a task once for every host. Orchestrators only do their work
+    # on the first of those invocations and then drive all hosts themselves.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if env.host_string and env.all_hosts and env.host_string != env.all_hosts[0]:
+            return None
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def _clusterTask(func):
+    # Run func on every host through _runOnCluster when invoked as a task, or
+    # directly when called from something already running on a host.
+    @_orchestrator
+    def runEverywhere(*args, **kwargs):
+        return _runOnCluster(func, *args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if env.get("clusterHost"):
+            return func(*args, **kwargs)
+        return runEverywhere(*args, **kwargs)
+    return wrapper
+
+
+def _runOnCluster(func, *args, **kwargs):
+    # An explicit empty host list (e.g. no slaves) means nothing to do
+    hosts = kwargs.pop("hosts", None)
+    if hosts is None:
+        hosts = env.all_hosts or env.hosts
+    if not hosts:
+        return {}
+    batchSize = int(env.get("rolling_batch_size") or ROLLING_BATCH_SIZE or len(hosts))
+
+    # Named after func, so that fab's output and the trace show what runs
+    taskName = func.__name__.lstrip("_")
+    task = fabric.tasks.WrappedCallableTask(_runTimedOnHost, name=taskName)
+    hostResults = {}
+    for i in range(0, len(hosts), batchSize):
+        hostResults.update(execute(task, func, *args,
+            hosts=hosts[i:i + batchSize], **kwargs))
+
+    _printHostResults(taskName, hostResults)
+
+    failedHosts = sorted(host for host, (status, _, _) in hostResults.items() if status != "ok")
+    if failedHosts:
+        abort("%s failed on %s" % (taskName, ", ".join(failedHosts)))
+    return dict((host, result) for host, (_, _, result) in hostResults.items())
+
+
+@parallel
+def _runTimedOnHost(func, *args, **kwargs):
+    startTime = time.time()
+    with settings(clusterHost=env.host):
+        try:
+            result = func(*args, **kwargs)
+        except (Exception, SystemExit) as e:
+            return ("failed", time.time() - startTime, str(e))
+    return ("ok", time.time() - startTime, result)
+
+
+def _printHostResults(taskName, hostResults):
+    print("%s on %d hosts:" % (taskName, len(hostResults)))
+    for host, (status, seconds, result) in sorted(hostResults.items(),
+            key=lambda item: -item[1][1]):
+        print("  %-40s %-6s %8.1fs%s" % (host, status, seconds,
+            " (%s)" % result if status != "ok" else ""))
+
+
+# STATE JOURNAL
+def _journaledStep(getInputs):
+    return journal.journaled_step(STATE_JOURNAL, getInputs)
+
+
+@_needsCluster
+@_clusterTask
+def resetJournal():
+    journal.reset_journal(STATE_JOURNAL)
+
+
+# RESOURCE SIZING
+AUTO_SIZED_VALUES = {}
+AUTO_SIZED_HOST_VALUES = {}
+# (node memory up to, memory reserved for the OS and other daemons) in GB,
+# as recommended by the HDP guide
+RESERVED_MEMORY_GB = [(4, 1), (8, 2), (16, 2), (24, 4), (48, 6), (64, 8), (72, 8),
+                      (96, 12), (128, 24), (256, 32), (512, 64)]
+
+def _withResourceSizing(func):
+    # Sizes the cluster, once, before func applies or checks configuration
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if (AUTO_SIZE_RESOURCES or env.get("auto_size_resources")) and \
+                not env.get("clusterHost") and not AUTO_SIZED_VALUES:
+            _sizeSlaves()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def _sizeSlaves():
+    # Only slaves run NodeManagers; the masters' hardware doesn't matter
+    if not SLAVE_HOSTS:
+        abort("There are no SLAVE_HOSTS to size resources from")
+    _sizeResources(_runOnCluster(_getNodeHardware, hosts=SLAVE_HOSTS))
+
+
+@_needsCluster
+@_orchestrator
+def autoSizeResources():
+    # Prints the sizing of the current slaves, and the equivalent per-host
+    # overrides to pin it in HOST_SITE_OVERRIDES, without changing anything.
+    _sizeSlaves()
+    print("Cluster-wide values:")
+    print(json.dumps(AUTO_SIZED_VALUES, indent=4, sort_keys=True))
+    print("HOST_SITE_OVERRIDES = %s" %
+          json.dumps(AUTO_SIZED_HOST_VALUES, indent=4, sort_keys=True))
+
+
+def _getNodeHardware():
+    probes = _runProbes({
+        "cores": "nproc",
+        "memory": "awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo",
+        "disks": "lsblk -d -n -o TYPE | grep -c disk",
+    })
+    disks = probes["disks"][1]
+    return {"cores": int(probes["cores"][1]), "memory": int(probes["memory"][1]),
+            "disks": max(1, int(disks)) if disks.isdigit() else 1}
+
+
+def _sizeNode(hardware):
+    # Returns (containers, memory per container in MB) for a node:
+    #   available = memory - reserved memory (RESERVED_MEMORY_GB)
+    #   containers = min(2 * cores, CONTAINERS_PER_DISK * disks,
+    #                    available / minimum container size)
+    #   memory per container = max(minimum container size, available / containers)
+    # with a minimum container size of 256 MB below 4 GB of memory, 512 MB
+    # below 8 GB, 1 GB below 24 GB and 2 GB above.
+    memory = hardware["memory"]
+    reservedGb = next((reserved for limit, reserved in RESERVED_MEMORY_GB
+                       if memory <= limit * 1024), RESERVED_MEMORY_GB[-1][1])
+    available = memory - reservedGb * 1024
+    minimumContainer = 256 if memory < 4096 else 512 if memory < 8192 else \
+        1024 if memory < 24576 else 2048
+
+    limits = [2 * hardware["cores"], float(available) / minimumContainer]
+    if AUTO_SIZE_CONTAINERS_PER_DISK:
+        limits.append(AUTO_SIZE_CONTAINERS_PER_DISK * hardware["disks"])
+    containers = max(1, int(min(limits)))
+    return containers, max(minimumContainer, available // containers)
+
+
+def _sizeResources(hardware):
+    # Each NodeManager offers all of its containers and cores. Container
+    # sizes are cluster-wide, so they come from the node with the smallest
+    # containers: maps get one container, reduces and the MapReduce AM two
+    # (at most the largest allocation every node can hold), and their heaps
+    # AUTO_SIZE_HEAP_RATIO of it. vmem-pmem-ratio lets the smallest container
+    # hold a JVM's virtual overhead: (container + overhead) / container,
+    # rounded up to a tenth, and never below YARN's default of 2.1.
+    global AUTO_SIZED_VALUES, AUTO_SIZED_HOST_VALUES
+
+    nodes = dict((host, _sizeNode(nodeHardware)) for host, nodeHardware in hardware.items())
+    containerMemory = min(memory for _, memory in nodes.values())
+    nodeMemory = dict((host, containers * memory) for host, (containers, memory) in nodes.items())
+    maximumAllocation = min(nodeMemory.values())
+    largeContainerMemory = min(2 * containerMemory, maximumAllocation)
+    vmemRatio = max(2.1, math.ceil(10.0 * (containerMemory + AUTO_SIZE_JVM_VMEM_OVERHEAD) /
+                                   containerMemory) / 10)
+
+    def heap(containerSize):
+        return "-Xmx%dm" % int(containerSize * AUTO_SIZE_HEAP_RATIO)
+
+    AUTO_SIZED_VALUES = {
+        "yarn-site.xml": {
+            "yarn.scheduler.minimum-allocation-mb": containerMemory,
+            "yarn.scheduler.maximum-allocation-mb": maximumAllocation,
+            "yarn.scheduler.maximum-allocation-vcores":
+                min(nodeHardware["cores"] for nodeHardware in hardware.values()),
+            "yarn.nodemanager.vmem-pmem-ratio": vmemRatio,
+        },
+        "mapred-site.xml": {
+            "mapreduce.map.memory.mb": containerMemory,
+            "mapreduce.map.java.opts": heap(containerMemory),
+            "mapreduce.reduce.memory.mb": largeContainerMemory,
+            "mapreduce.reduce.java.opts": heap(largeContainerMemory),
+            "yarn.app.mapreduce.am.resource.mb": largeContainerMemory,
+            "yarn.app.mapreduce.am.command-opts": heap(largeContainerMemory),
+        },
+    }
+    AUTO_SIZED_HOST_VALUES = dict((host, {"yarn-site.xml": {
+        "yarn.nodemanager.resource.memory-mb": nodeMemory[host],
+        "yarn.nodemanager.resource.cpu-vcores": hardware[host]["cores"],
+    }}) for host in hardware)
+
+    print("Resources sized from the hardware of %d slaves:" % len(hardware))
+    print("  %-40s %6s %9s %6s %11s %10s" %
+          ("host", "cores", "memory", "disks", "containers", "per node"))
+    for host, nodeHardware in sorted(hardware.items()):
+        print("  %-40s %6d %7dMB %6d %11d %8dMB" %
+              (host, nodeHardware["cores"], nodeHardware["memory"], nodeHardware["disks"],
+               nodeMemory[host] // containerMemory, nodeMemory[host]))
+    print("  %dMB containers, vmem-pmem-ratio %.1f" % (containerMemory, vmemRatio))
+
+
+# DATA DISKS
+DATA_DISKS = {}
+
+DATA_DISK_SCRIPT = """\
+i=0; formatted=""
+for dev in $(lsblk -d -n -p -o NAME,TYPE | awk '$2 == "disk" {print $1}'); do
+    [ "$(lsblk -n -o NAME $dev | wc -l)" -eq 1 ] || continue
+    [ -z "$(lsblk -n -o MOUNTPOINT $dev | tr -d '[:space:]')" ] || continue
+    blkid -p $dev > /dev/null 2>&1 && continue
+    while mountpoint -q %(prefix)s$i || grep -q "[[:space:]]%(prefix)s$i[[:space:]]" /etc/fstab; do
+        i=$((i + 1))
+    done
+    mkdir -p %(prefix)s$i
+    mkfs -t %(fs)s %(mkfsOptions)s $dev > /dev/null &
+    formatted="$formatted $dev:%(prefix)s$i"
+    i=$((i + 1))
+done
+wait
+for disk in $formatted; do
+    dev=${disk%%:*}; dir=${disk#*:}
+    uuid=$(blkid -s UUID -o value $dev)
+    [ -n "$uuid" ] || { echo "Formatting $dev failed" >&2; exit 1; }
+    echo "UUID=$uuid $dir %(fs)s %(mountOptions)s 0 2" >> /etc/fstab
+    mount $dir && chown %(user)s $dir && echo "Mounted $dev on $dir"
+done"""
+
+
+@_needsCluster
+@_clusterTask
+def setupDataDisks():
+    # Formats and mounts the blank disks of a host, all at once, and creates
+    # the Hadoop directories on every data disk
+    sudo(DATA_DISK_SCRIPT % {"prefix": DATA_DISK_PREFIX, "fs": DATA_DISK_FILESYSTEM,
+                             "mkfsOptions": DATA_DISK_MKFS_OPTIONS,
+                             "mountOptions": DATA_DISK_MOUNT_OPTIONS, "user": env.user})
+    DATA_DISKS.pop(env.host, None)
+    disks = _getDataDisks()
+    if disks:
+        run("mkdir -p %s" % " ".join(os.path.join(disk, directory) for disk in disks
+                                     for directory in ("hdfs/datanode", "yarn/local",
+                                                       "yarn/logs", "hadoop/tmp")))
+    return disks
+
+
+def _getDataDisks():
+    # Read once per host, like the journal
+    if env.host not in DATA_DISKS:
+        with settings(hide('everything'), warn_only=True):
+            output = run("findmnt -n -r -o TARGET | grep -E '^%s[0-9]+$' | sort -V" %
+                         DATA_DISK_PREFIX)
+        DATA_DISKS[env.host] = [line.strip() for line in output.splitlines()
+                                if line.strip().startswith(DATA_DISK_PREFIX)]
+    return DATA_DISKS[env.host]
+
+
+def _getDataDiskValues():
+    disks = _getDataDisks() if MULTI_DISK_LAYOUT else []
+    if not disks:
+        return {}
+    return {
+        "core-site.xml": {"hadoop.tmp.dir": os.path.join(disks[0], "hadoop/tmp")},
+        "hdfs-site.xml": {"dfs.datanode.data.dir": ",".join(
+            "file://%s" % os.path.join(disk, "hdfs/datanode") for disk in disks)},
+        "yarn-site.xml": {
+            "yarn.nodemanager.local-dirs": ",".join(
+                os.path.join(disk, "yarn/local") for disk in disks),
+            "yarn.nodemanager.log-dirs": ",".join(
+                os.path.join(disk, "yarn/logs") for disk in disks),
+        },
+    }
+
+
 # MAIN FUNCTIONS
+@_needsCluster
 def forceStopEveryJava():
     run("jps | grep -vi jps | cut -d ' ' -f 1 | xargs -L1 -r kill")
 
 
 @runs_once
 def debugHosts():
+    bootstrapFabric()
     print("Resource Manager: {}".format(RESOURCEMANAGER_HOST))
     print("Name node: {}".format(NAMENODE_HOST))
     print("Job Tracker: {}".format(JOBTRACKER_HOST))
@@ -251,27 +674,45 @@ def debugHosts():
     print("Slaves: {}".format(SLAVE_HOSTS))
 
 
+@_needsCluster
+@_withResourceSizing
+@_orchestrator
 def bootstrap():
+    # Nodes need their dependencies (wget, python) to relay the package.
+    _runOnCluster(_prepareNode)
+    _distributeHadoopPackage()
+    _runOnCluster(_setupNode)
+    setupHosts()
+    execute(formatHdfs, hosts=[NAMENODE_HOST])
+
+
+def _prepareNode():
+    if MULTI_DISK_LAYOUT:
+        setupDataDisks()
     with settings(warn_only=True):
-        if EC2_INSTANCE_STORAGEDEV and run("mountpoint /mnt").failed:
+        if EC2_INSTANCE_STORAGEDEV and not MULTI_DISK_LAYOUT and run("mountpoint /mnt").failed:
             sudo("mkfs.ext4 %s" % EC2_INSTANCE_STORAGEDEV)
             sudo("mount %s /mnt" % EC2_INSTANCE_STORAGEDEV)
             sudo("chmod 0777 /mnt")
             sudo("rm -rf /tmp/hadoop-ubuntu")
     ensureImportantDirectoriesExist()
     installDependencies()
-    install()
+
+
+def _setupNode():
+    _extractHadoopPackage()
     setupEnvironment()
     config()
-    setupHosts()
-    formatHdfs()
 
 
+@_needsCluster
+@_journaledStep(lambda: IMPORTANT_DIRS)
 def ensureImportantDirectoriesExist():
-    for importantDir in IMPORTANT_DIRS:
-        ensureDirectoryExists(importantDir)
+    run("mkdir -p %s" % " ".join(IMPORTANT_DIRS))
 
 
+@_needsCluster
+@_journaledStep(lambda: (REQUIREMENTS_PRE_COMMANDS, REQUIREMENTS, PACKAGE_MANAGER_INSTALL))
 def installDependencies():
     for command in REQUIREMENTS_PRE_COMMANDS:
         sudo(command)
@@ -279,23 +720,138 @@ def installDependencies():
         sudo(PACKAGE_MANAGER_INSTALL % requirement)
 
 
+@_needsCluster
+@_orchestrator
 def install():
-    installDirectory = os.path.dirname(HADOOP_PREFIX)
-    run("mkdir -p %s" % installDirectory)
-    with cd(installDirectory):
-        with settings(warn_only=True):
-            if run("test -f %s.tar.gz" % HADOOP_PACKAGE).failed:
-                run("wget -O %s.tar.gz %s" % (HADOOP_PACKAGE, HADOOP_PACKAGE_URL))
+    _distributeHadoopPackage()
+    _runOnCluster(_extractHadoopPackage)
+
+
+def _distributeHadoopPackage():
+    artifacts.distribute_artifact(HADOOP_PACKAGE_URL,
+        os.path.join(os.path.dirname(HADOOP_PREFIX), "%s.tar.gz" % HADOOP_PACKAGE),
+        HADOOP_PACKAGE_SHA256)
+
+
+@_journaledStep(lambda: (HADOOP_PACKAGE_URL, HADOOP_PREFIX))
+def _extractHadoopPackage():
+    with cd(os.path.dirname(HADOOP_PREFIX)):
         run("tar --overwrite -xf %s.tar.gz" % HADOOP_PACKAGE)
 
 
+@_withResourceSizing
+@_clusterTask
+# Extracting a package overwrites the site files with its defaults, so the
+# package and where it is installed are inputs too
+@_needsCluster
+@_journaledStep(lambda: (_getHadoopSiteFiles(), CONFIGURATION_FILES_CLEAN,
+                         HADOOP_PACKAGE_URL, HADOOP_PREFIX, HADOOP_CONF))
 def config():
-    changeHadoopProperties("core-site.xml", CORE_SITE_VALUES)
-    changeHadoopProperties("hdfs-site.xml", HDFS_SITE_VALUES)
-    changeHadoopProperties("yarn-site.xml", YARN_SITE_VALUES)
-    changeHadoopProperties("mapred-site.xml", MAPRED_SITE_VALUES)
+    # Returns whether any site file changed (None if the journal skipped it)
+    return _applyHadoopSiteFiles()
 
 
+def _applyHadoopSiteFiles():
+    if CONFIGURATION_BATCHED:
+        return _changeHadoopPropertiesBatched(_getHadoopSiteFiles())
+
+    changed = False
+    for fileName, propertyDict in _getHadoopSiteFiles():
+        changed = changeHadoopProperties(fileName, propertyDict) or changed
+    return changed
+
+
+@_needsCluster
+@_withResourceSizing
+@_clusterTask
+def configDryRun():
+    return _changeHadoopPropertiesBatched(_getHadoopSiteFiles(), dryRun=True)
+
+
+@_needsCluster
+@_withResourceSizing
+@_orchestrator
+def reconfigure():
+    # Daemons are only restarted on the hosts whose configuration changed.
+    changedHosts = [host for host, changed in _runOnCluster(config).items() if changed]
+    if not changedHosts:
+        print("Configuration unchanged on every host, no daemons restarted")
+        return
+    _runOnCluster(_restartDaemons, hosts=changedHosts)
+
+
+@_needsCluster
+@_withResourceSizing
+@_orchestrator
+def configDrift():
+    # Compares, on every host in parallel, the digest of the deployed values
+    # of the managed properties with that of the desired ones.
+    driftedFiles = _runOnCluster(_getConfigDrift)
+    _printConfigDrift(driftedFiles)
+    return driftedFiles
+
+
+@_needsCluster
+@_withResourceSizing
+@_orchestrator
+def configSync():
+    # Rewrites the site files of drifted hosts only; hosts already in sync
+    # aren't touched, so no backups or file rewrites happen there.
+    driftedHosts = sorted(host for host, fileNames in configDrift().items() if fileNames)
+    if not driftedHosts:
+        print("No configuration drift, nothing to do")
+        return
+    _runOnCluster(_applyHadoopSiteFiles, hosts=driftedHosts)
+
+
+def _getConfigDrift():
+    payload = _getHadoopPropertiesPayload(_getHadoopSiteFiles())
+    _uploadHadoopProperties(payload)
+    with cd(HADOOP_CONF):
+        with settings(hide('stdout')):
+            output = run("./replaceHadoopProperty.py --digest --batch hadoopProperties.json")
+    deployedDigests = dict(line.split() for line in output.splitlines() if len(line.split()) == 2)
+    return sorted(fileName for fileName, properties in payload.items()
+                  if deployedDigests.get(fileName) != replaceHadoopProperty.propertiesDigest(properties))
+
+
+def _printConfigDrift(driftedFiles):
+    numDrifted = len([host for host in driftedFiles if driftedFiles[host]])
+    print("Configuration drift on %d of %d hosts:" % (numDrifted, len(driftedFiles)))
+    for host, fileNames in sorted(driftedFiles.items()):
+        print("  %-40s %s" % (host, ", ".join(fileNames) if fileNames else "in sync"))
+
+
+@_needsCluster
+def benchmarkConfig():
+    # Both paths start from the configuration the host had, which is put
+    # back once they are done, so that neither finds its work already done.
+    _ensureRemoteScript("replaceHadoopProperty.py", HADOOP_CONF)
+    snapshot = run("mktemp -d").strip()
+    run("cp -a %s/. %s" % (HADOOP_CONF, snapshot))
+    restore = "rm -rf %(conf)s && cp -a %(snapshot)s %(conf)s" % \
+        {"conf": HADOOP_CONF, "snapshot": snapshot}
+
+    timings = []
+    try:
+        for label, batched in (("per-file", False), ("batched", True)):
+            run(restore)
+            startTime = time.time()
+            if batched:
+                _changeHadoopPropertiesBatched(_getHadoopSiteFiles())
+            else:
+                for fileName, propertyDict in _getHadoopSiteFiles():
+                    changeHadoopProperties(fileName, propertyDict)
+            timings.append((label, time.time() - startTime))
+    finally:
+        run("%s && rm -rf %s" % (restore, snapshot))
+
+    print("Configuration timings on %s:" % env.host)
+    for label, seconds in timings:
+        print("  %-10s %6.2fs" % (label, seconds))
+
+
+@_needsCluster
 def configRevertPrevious():
     revertHadoopPropertiesChange("core-site.xml")
     revertHadoopPropertiesChange("hdfs-site.xml")
@@ -303,7 +859,13 @@ def configRevertPrevious():
     revertHadoopPropertiesChange("mapred-site.xml")
 
 
+@_needsCluster
+@_clusterTask
+@_journaledStep(lambda: (ENVIRONMENT_FILE, ENVIRONMENT_VARIABLES, ENVIRONMENT_FILE_CLEAN))
 def setupEnvironment():
+    if ENVIRONMENT_SINGLE_PASS:
+        return _setupEnvironmentSinglePass()
+
     with settings(warn_only=True):
         if not run("test -f %s" % ENVIRONMENT_FILE).failed:
             op = "cp"
@@ -329,42 +891,200 @@ def setupEnvironment():
                 {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
 
 
+def _setupEnvironmentSinglePass():
+    # ENVIRONMENT_VARIABLES are escaped for the two shells the echo and sed
+    # commands above go through; the merge script writes them verbatim.
+    variables = [(variable, value.replace(r"\\$", "$"))
+                 for variable, value in ENVIRONMENT_VARIABLES]
+
+    _ensureRemoteScript("replaceEnvironmentVariables.py", HADOOP_PREFIX)
+    put(StringIO.StringIO(json.dumps(variables)), HADOOP_PREFIX + "/environment.json")
+
+    command = "%(dir)s/replaceEnvironmentVariables.py %(file)s %(dir)s/environment.json" % \
+        {"dir": HADOOP_PREFIX, "file": ENVIRONMENT_FILE}
+    if ENVIRONMENT_FILE_CLEAN:
+        command += " --clean"
+    return run(command)
+
+
+@_needsCluster
 def environmentRevertPrevious():
     revertBackup(ENVIRONMENT_FILE)
 
 
+@_needsCluster
+@_journaledStep(lambda: (NAMENODE_HOST, HDFS_NAME_DIR))
 def formatHdfs():
     if env.host == NAMENODE_HOST:
         operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hdfs namenode -format")
 
 
+@_needsCluster
 @runs_once
 def setupHosts():
     privateIps = execute(getPrivateIp)
     execute(updateHosts, privateIps)
+    execute(_writePrivateIps, privateIps, hosts=[RESOURCEMANAGER_HOST])
 
-    if env.host == RESOURCEMANAGER_HOST:
-        run("rm -f privateIps")
-        run("touch privateIps")
 
-        for host, privateIp in privateIps.items():
-            run("echo '%s' >> privateIps" % privateIp)
+def _writePrivateIps(privateIps):
+    put(StringIO.StringIO("".join("%s\n" % privateIp for privateIp in privateIps.values())),
+        "privateIps")
 
 
-def start():
-    operationOnHadoopDaemons("start")
+@_needsCluster
+def benchmarkRoundTrips(count=20):
+    # Latency of count trivial checks issued one command at a time, as most
+    # helpers used to, versus pipelined into a single round trip.
+    count = int(count)
+    _runProbes({"warmup": "true"})
 
+    startTime = time.time()
+    with settings(hide('everything')):
+        for i in range(count):
+            run("test -d /")
+    sequential = time.time() - startTime
 
-def stop():
-    operationOnHadoopDaemons("stop")
+    startTime = time.time()
+    _runProbes(dict(("probe%d" % i, "test -d /") for i in range(count)))
+    pipelined = time.time() - startTime
+
+    print("%d checks on %s:" % (count, env.host))
+    print("  %-12s %8.3fs %8.1fms per check" % ("sequential", sequential, sequential * 1000 / count))
+    print("  %-12s %8.3fs %8.1fms per check" % ("pipelined", pipelined, pipelined * 1000 / count))
+
+
+@runs_once
+def benchmarkStartup(count=5):
+    # Listing the tasks shouldn't need the cluster at all
+    tracing.benchmark_startup(__file__, count)
+
+
+@_needsCluster
+def benchmarkHostsUpdate():
+    print("Remote commands and uploads needed to update the hosts files of N hosts:")
+    print("  %6s %14s %14s" % ("N", "per-entry", "managed-block"))
+    for numHosts in (10, 100, 1000):
+        privateIps = dict(("slave%d" % i, "10.0.%d.%d" % (i // 256, i % 256))
+                          for i in range(numHosts))
+        perEntry = _countRemoteCommands(_updateHostsPerEntry, privateIps)
+        managedBlock = _countRemoteCommands(_updateHostsManagedBlock, privateIps)
+        print("  %6d %14d %14d" % (numHosts, perEntry * numHosts, managedBlock * numHosts))
+
+
+class _SimulatedOutput(str):
+    failed = False
+    succeeded = True
+    return_code = 0
+
+
+def _countRemoteCommands(func, *args):
+    # Runs func with run/sudo/put replaced by stand-ins that only count the
+    # remote commands and uploads it would have issued on one host.
+    counts = {"operations": 0}
+
+    def simulatedOperation(*args, **kwargs):
+        counts["operations"] += 1
+        return _SimulatedOutput("")
+
+    originals = dict((name, globals()[name]) for name in ("run", "sudo", "put"))
+    globals().update(run=simulatedOperation, sudo=simulatedOperation,
+                     put=simulatedOperation)
+    try:
+        func(*args)
+    finally:
+        globals().update(originals)
+    return counts["operations"]
+
+
+@_needsCluster
+@_orchestrator
+def start():
+    for daemon in DAEMON_START_ORDER:
+        print("Starting %s" % daemon)
+        _runOnCluster(_startDaemon, daemon, hosts=_getDaemonHosts(daemon))
 
 
+@_needsCluster
+@_orchestrator
+def stop():
+    for daemon in reversed(DAEMON_START_ORDER):
+        print("Stopping %s" % daemon)
+        _runOnCluster(_stopDaemon, daemon, hosts=_getDaemonHosts(daemon))
+
+
+@_needsCluster
+@_orchestrator
+def rollingRestart(batchSize=ROLLING_RESTART_BATCH_SIZE):
+    # Cycles the worker daemons batchSize hosts at a time, waiting for each
+    # batch to be ready again before moving on, so that running jobs only
+    # ever lose that much capacity. Masters are left alone.
+    batchSize = int(batchSize)
+    # Either list may hold user@host strings; compare the host names
+    slaves = set(normalize(host)[1] for host in SLAVE_HOSTS)
+    workers = [host for host in env.all_hosts or SLAVE_HOSTS if normalize(host)[1] in slaves]
+    for i in range(0, len(workers), batchSize):
+        _runOnCluster(_restartDaemons, WORKER_DAEMONS, hosts=workers[i:i + batchSize])
+
+
+def _restartDaemons(daemons=None):
+    hostDaemons = [daemon for daemon in DAEMON_START_ORDER
+                   if env.host in _getDaemonHosts(daemon) and (daemons is None or daemon in daemons)]
+    for daemon in reversed(hostDaemons):
+        _stopDaemon(daemon)
+    for daemon in hostDaemons:
+        _startDaemon(daemon)
+
+
+def _getDaemonHosts(daemon):
+    masterHosts = {
+        "namenode": NAMENODE_HOST,
+        "resourcemanager": RESOURCEMANAGER_HOST,
+        "historyserver": JOBHISTORY_HOST,
+    }
+    if daemon in masterHosts:
+        return [masterHosts[daemon]] if masterHosts[daemon] else []
+    return SLAVE_HOSTS
+
+
+def _startDaemon(daemon):
+    script, javaClass, port = HADOOP_DAEMONS[daemon]
+    with settings(hide('everything'), warn_only=True):
+        running = run("jps | grep -qw %s" % javaClass).succeeded
+    if not running:
+        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/%s start %s" % (script, daemon))
+    _waitForDaemon(daemon)
+
+
+def _stopDaemon(daemon):
+    script, _, _ = HADOOP_DAEMONS[daemon]
+    operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/%s stop %s" % (script, daemon))
+
+
+def _waitForDaemon(daemon):
+    # A single remote loop waits for the JVM to show up in jps and for its
+    # port to be listened on, instead of one ssh round trip per check.
+    _, javaClass, port = HADOOP_DAEMONS[daemon]
+    startTime = time.time()
+    with settings(hide('everything'), warn_only=True):
+        result = run("while [ $SECONDS -lt %(timeout)d ]; do "
+            "jps | grep -qw %(class)s && "
+            "(ss -ltn 2>/dev/null || netstat -ltn) | grep -q ':%(port)d ' && exit 0; "
+            "sleep 1; done; exit 1" %
+            {"timeout": DAEMON_READY_TIMEOUT, "class": javaClass, "port": port})
+    if result.failed:
+        abort("%s not ready on %s after %ds" % (daemon, env.host, DAEMON_READY_TIMEOUT))
+    print("%s ready on %s after %.1fs" % (daemon, env.host, time.time() - startTime))
+
+
+@_needsCluster
 def test():
     if env.host == RESOURCEMANAGER_HOST:
         operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar org.apache.hadoop.yarn.applications.distributedshell.Client --jar \\$HADOOP_PREFIX/share/hadoop/yarn/hadoop-yarn-applications-distributedshell-%(version)s.jar --shell_command date --num_containers %(numContainers)d --master_memory 1024" %
             {"version": HADOOP_VERSION, "numContainers": len(SLAVE_HOSTS)})
 
 
+@_needsCluster
 def testMapReduce():
     if env.host == RESOURCEMANAGER_HOST:
         operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/bin/hadoop dfs -rm -f -r out")
@@ -372,12 +1092,7 @@ def testMapReduce():
 
 
 # HELPER FUNCTIONS
-def ensureDirectoryExists(directory):
-    with settings(warn_only=True):
-        if run("test -d %s" % directory).failed:
-            run("mkdir -p %s" % directory)
-
-
+@_needsCluster
 @parallel
 def getPrivateIp():
     if not EC2:
@@ -386,8 +1101,25 @@ def getPrivateIp():
         return run("wget -qO- http://instance-data/latest/meta-data/local-ipv4")
 
 
+@_needsCluster
 @parallel
 def updateHosts(privateIps):
+    if HOSTS_MANAGED_BLOCK:
+        _updateHostsManagedBlock(privateIps)
+    else:
+        _updateHostsPerEntry(privateIps)
+
+
+def _updateHostsManagedBlock(privateIps):
+    entries = "".join("%s %s\n" % (privateIp, host)
+                      for host, privateIp in sorted(privateIps.items()))
+    _ensureRemoteScript("replaceHostsBlock.py", HADOOP_PREFIX)
+    put(StringIO.StringIO(entries), HADOOP_PREFIX + "/clusterHosts")
+    sudo("%(dir)s/replaceHostsBlock.py %(file)s %(dir)s/clusterHosts" %
+        {"dir": HADOOP_PREFIX, "file": HOSTS_FILE})
+
+
+def _updateHostsPerEntry(privateIps):
     with settings(warn_only=True):
         if not run("test -f %s" % HOSTS_FILE).failed:
             currentBakNumber = getLastBackupNumber(HOSTS_FILE) + 1
@@ -408,115 +1140,138 @@ def updateHosts(privateIps):
                 {"host": host, "ip": privateIp, "file": HOSTS_FILE})
 
 
+@_needsCluster
 def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
-    fileName = os.path.basename(filePath)
+    latestBak = run(_getLastBackupNumberCommand(filePath))
+    return int(latestBak) if latestBak else -1
+
+
+def _getLastBackupNumberCommand(filePath):
+    # Numeric sort, so that .bak10 comes after .bak9
+    return ("ls -1 %s.bak* 2>/dev/null | sed -n 's/^.*\\.bak\\([0-9][0-9]*\\)$/\\1/p' | "
+            "sort -n | tail -n 1" % filePath)
 
-    with cd(dirName):
-        latestBak = run("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
 
+UPLOADED_SCRIPTS = set()
 
+# Local modules the helper scripts import, uploaded next to them
+SCRIPT_MODULES = {
+    "replaceHadoopProperty.py": ["fileBackups.py"],
+    "replaceEnvironmentVariables.py": ["fileBackups.py"],
+    "replaceHostsBlock.py": ["fileBackups.py"],
+}
+
+def _ensureRemoteScript(fileName, remoteDir):
+    # Uploads a helper script unless the host already has this version. Each
+    # process checks every host only once, instead of before every use.
+    if (env.host, fileName, remoteDir) in UPLOADED_SCRIPTS:
+        return
+    for module in SCRIPT_MODULES.get(fileName, []):
+        _ensureRemoteScript(module, remoteDir)
+    with open(fileName, "rb") as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    remotePath = os.path.join(remoteDir, fileName)
+    with settings(hide('everything'), warn_only=True):
+        upToDate = run("test %s = `md5sum %s | cut -d ' ' -f 1`" % (digest, remotePath)).succeeded
+    if not upToDate:
+        put(fileName, remotePath, mode=0o755)
+    UPLOADED_SCRIPTS.add((env.host, fileName, remoteDir))
+
+
+@_needsCluster
 def changeHadoopProperties(fileName, propertyDict):
     if not fileName or not propertyDict:
-        return
+        return False
 
-    with cd(HADOOP_CONF):
-        with settings(warn_only=True):
-            import hashlib
-            replaceHadoopPropertyHash = \
-                hashlib.md5(
-                    open("replaceHadoopProperty.py", 'rb').read()
-                ).hexdigest()
-            if run("test %s = `md5sum replaceHadoopProperty.py | cut -d ' ' -f 1`"
-                   % replaceHadoopPropertyHash).failed:
-                put("replaceHadoopProperty.py", HADOOP_CONF + "/")
-                run("chmod +x replaceHadoopProperty.py")
-
-        with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
-
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
-
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
-
-        run("touch %s" % fileName)
-
-        command = "./replaceHadoopProperty.py '%s' %s" % (fileName,
-            " ".join(["'%s' '%s'" % (str(key), str(value)) for key, value in propertyDict.items()]))
-        run(command)
+    _ensureRemoteScript("replaceHadoopProperty.py", HADOOP_CONF)
 
+    # The script backs the file up itself, and only if it changes
+    arguments = "'%s' %s" % (fileName,
+        " ".join(["'%s' '%s'" % (str(key), str(value)) for key, value in propertyDict.items()]))
+    if CONFIGURATION_FILES_CLEAN:
+        arguments += " --clean"
+    return _runReplaceHadoopProperty(arguments)
 
-def revertBackup(fileName):
-    dirName = os.path.dirname(fileName)
 
-    with cd(dirName):
-        latestBakNumber = getLastBackupNumber(fileName)
-
-        # We have already reverted all backups
-        if latestBakNumber == -1:
-            return
-        # Otherwise, perform reversion
-        else:
-            run("mv %(file)s.bak%(bakNumber)d %(file)s" %
-                {"file": fileName, "bakNumber": latestBakNumber})
+def _runReplaceHadoopProperty(arguments):
+    # Returns whether any property was (or, with --dry-run, would be) changed.
+    with cd(HADOOP_CONF):
+        with settings(hide('warnings'), warn_only=True):
+            result = run("./replaceHadoopProperty.py --exit-code %s" % arguments)
+    if result.return_code not in (0, replaceHadoopProperty.CHANGED_EXIT_CODE):
+        abort("replaceHadoopProperty.py failed on %s" % env.host)
+    return result.return_code == replaceHadoopProperty.CHANGED_EXIT_CODE
+
+
+def _getHadoopSiteFiles():
+    siteFiles = [
+        ("core-site.xml", CORE_SITE_VALUES),
+        ("hdfs-site.xml", HDFS_SITE_VALUES),
+        ("yarn-site.xml", YARN_SITE_VALUES),
+        ("mapred-site.xml", MAPRED_SITE_VALUES),
+    ]
+    # Auto-sized values, then those of this host, take precedence
+    layers = [AUTO_SIZED_VALUES, AUTO_SIZED_HOST_VALUES.get(env.host, {}),
+              _getDataDiskValues(), HOST_SITE_OVERRIDES.get(env.host, {})]
+    mergedSiteFiles = []
+    for fileName, propertyDict in siteFiles:
+        propertyDict = dict(propertyDict)
+        for layer in layers:
+            propertyDict.update(layer.get(fileName, {}))
+        mergedSiteFiles.append((fileName, propertyDict))
+    return mergedSiteFiles
+
+
+def _getHadoopPropertiesPayload(siteFiles):
+    return dict((fileName, dict((str(key), str(value)) for key, value in propertyDict.items()))
+                for fileName, propertyDict in siteFiles if propertyDict)
+
+
+def _uploadHadoopProperties(payload):
+    _ensureRemoteScript("replaceHadoopProperty.py", HADOOP_CONF)
+    put(StringIO.StringIO(json.dumps(payload)), HADOOP_CONF + "/hadoopProperties.json")
+
+
+def _changeHadoopPropertiesBatched(siteFiles, dryRun=False):
+    payload = _getHadoopPropertiesPayload(siteFiles)
+    if not payload:
+        return False
+
+    # Uploads don't go through the shell, so the only remote command issued
+    # is the one that backs up, rewrites and diffs every file at once.
+    _uploadHadoopProperties(payload)
+
+    arguments = "--batch hadoopProperties.json"
+    if CONFIGURATION_FILES_CLEAN:
+        arguments += " --clean"
+    if dryRun:
+        arguments += " --dry-run"
+    return _runReplaceHadoopProperty(arguments)
+
+
+@_needsCluster
+def revertBackup(fileName):
+    # Nothing happens once all backups have been reverted
+    run("n=$(%(last)s); [ -z \"$n\" ] || mv %(file)s.bak$n %(file)s" %
+        {"last": _getLastBackupNumberCommand(fileName), "file": fileName})
 
 
+@_needsCluster
 def revertHadoopPropertiesChange(fileName):
     revertBackup(os.path.join(HADOOP_CONF, fileName))
 
 
+@_needsCluster
 def operationInHadoopEnvironment(operation):
     with cd(HADOOP_PREFIX):
         command = operation
         if ENVIRONMENT_FILE_NOTAUTOLOADED:
-            with settings(warn_only=True):
-                import hashlib
-                executeInHadoopEnvHash = \
-                    hashlib.md5(
-                        open("executeInHadoopEnv.sh", 'rb').read()
-                    ).hexdigest()
-                if run("test %s = `md5sum executeInHadoopEnv.sh | cut -d ' ' -f 1`"
-                    % executeInHadoopEnvHash).failed:
-                    put("executeInHadoopEnv.sh", HADOOP_PREFIX + "/")
-                    run("chmod +x executeInHadoopEnv.sh")
+            _ensureRemoteScript("executeInHadoopEnv.sh", HADOOP_PREFIX)
             command = ("./executeInHadoopEnv.sh %s " % ENVIRONMENT_FILE) + command
         run(command)
 
 
-def operationOnHadoopDaemons(operation):
-    # Start/Stop NameNode
-    if (env.host == NAMENODE_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/hadoop-daemon.sh %s namenode" % operation)
-
-    # Start/Stop DataNode on all slave hosts
-    if env.host in SLAVE_HOSTS:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/hadoop-daemon.sh %s datanode" % operation)
-
-    # Start/Stop ResourceManager
-    if (env.host == RESOURCEMANAGER_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/yarn-daemon.sh %s resourcemanager" % operation)
-
-    # Start/Stop NodeManager on all container hosts
-    if env.host in SLAVE_HOSTS:
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/yarn-daemon.sh %s nodemanager" % operation)
-
-    # Start/Stop JobHistory daemon
-    if (env.host == JOBHISTORY_HOST):
-        operationInHadoopEnvironment(r"\\$HADOOP_PREFIX/sbin/mr-jobhistory-daemon.sh %s historyserver" % operation)
-    run("jps")
-
-
 def readHostsFromEC2():
-    import boto.ec2
-
     global RESOURCEMANAGER_HOST, NAMENODE_HOST, JOBTRACKER_HOST, \
         JOBHISTORY_HOST, SLAVE_HOSTS
 
@@ -526,14 +1281,9 @@ def readHostsFromEC2():
     JOBHISTORY_HOST = None
     SLAVE_HOSTS = []
 
-    conn = boto.ec2.connect_to_region(EC2_REGION,
-            aws_access_key_id=AWS_ACCESSKEY_ID,
-            aws_secret_access_key=AWS_ACCESSKEY_SECRET)
-    instances = conn.get_only_instances(filters={'tag:Cluster': EC2_CLUSTER_NAME})
-
-    for instance in instances:
-        instanceTags = instance.tags
-        instanceHost = instance.public_dns_name
+    for instance in _readEC2Inventory():
+        instanceTags = instance["tags"]
+        instanceHost = instance["host"]
 
         if "resourcemanager" in instanceTags:
             RESOURCEMANAGER_HOST = instanceHost
@@ -554,8 +1304,9 @@ def readHostsFromEC2():
         if RESOURCEMANAGER_HOST is None:
             RESOURCEMANAGER_HOST = SLAVE_HOSTS[0]
 
-            if EC2_RM_NONSLAVE:
-                SLAVE_HOSTS.remove(0)
+            # A single node has to be a slave as well
+            if EC2_RM_NONSLAVE and len(SLAVE_HOSTS) > 1:
+                SLAVE_HOSTS.remove(RESOURCEMANAGER_HOST)
 
         if NAMENODE_HOST is None:
             NAMENODE_HOST = RESOURCEMANAGER_HOST
@@ -566,4 +1317,114 @@ def readHostsFromEC2():
         if JOBHISTORY_HOST is None:
             JOBHISTORY_HOST = SLAVE_HOSTS[0]
 
-bootstrapFabric()
+
+def _readEC2Inventory():
+    # Returns the cached instances, [{"host": ..., "tags": [...]}], sorted by
+    # host, and only asks EC2 when the cache is missing, too old or was made
+    # with other settings.
+    inventory = _loadEC2Inventory()
+    if inventory:
+        age = time.time() - inventory["time"]
+        if age < EC2_INVENTORY_TTL:
+            return inventory["instances"]
+        if age < EC2_INVENTORY_MAX_AGE:
+            _refreshEC2InventoryInBackground()
+            return inventory["instances"]
+    return _saveEC2Inventory(_fetchEC2Instances())
+
+
+def _getEC2InventoryKey():
+    return [EC2_REGION, EC2_ENDPOINT, EC2_CLUSTER_NAME, EC2_FILTERS]
+
+
+def _loadEC2Inventory():
+    try:
+        with open(EC2_INVENTORY_FILE) as f:
+            inventory = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return inventory if inventory.get("key") == _getEC2InventoryKey() else None
+
+
+def _saveEC2Inventory(instances):
+    # Written to a temporary file and renamed, so that readers never see a
+    # partial inventory
+    inventoryDir = os.path.dirname(EC2_INVENTORY_FILE)
+    if not os.path.isdir(inventoryDir):
+        os.makedirs(inventoryDir)
+    tempFile = "%s.%d" % (EC2_INVENTORY_FILE, os.getpid())
+    with open(tempFile, "w") as f:
+        json.dump({"key": _getEC2InventoryKey(), "time": time.time(),
+                   "instances": instances}, f, indent=2)
+    os.rename(tempFile, EC2_INVENTORY_FILE)
+    return instances
+
+
+def _refreshEC2InventoryInBackground():
+    # Forks twice so that the refresh outlives fab without leaving a zombie
+    # behind. A lock keeps concurrent fab runs from refreshing it together.
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        if os.fork() == 0:
+            os.setsid()
+            devNull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devNull, fd)
+            with open(EC2_INVENTORY_FILE + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                _saveEC2Inventory(_fetchEC2Instances())
+    except Exception:
+        pass
+    finally:
+        os._exit(0)
+
+
+def _fetchEC2Instances():
+    filters = dict(EC2_FILTERS)
+    filters["tag:Cluster"] = EC2_CLUSTER_NAME
+    conn = _connectToEC2()
+
+    instances = []
+    nextToken = None
+    while True:
+        reservations = conn.get_all_reservations(filters=filters,
+            max_results=EC2_PAGE_SIZE, next_token=nextToken)
+        for reservation in reservations:
+            instances.extend({"host": instance.public_dns_name, "tags": sorted(instance.tags)}
+                             for instance in reservation.instances if instance.public_dns_name)
+        nextToken = reservations.next_token
+        if not nextToken:
+            break
+    return sorted(instances, key=lambda instance: instance["host"])
+
+
+def _connectToEC2():
+    import boto.ec2
+
+    if not EC2_ENDPOINT:
+        return boto.ec2.connect_to_region(EC2_REGION,
+                aws_access_key_id=AWS_ACCESSKEY_ID,
+                aws_secret_access_key=AWS_ACCESSKEY_SECRET)
+
+    from urlparse import urlparse
+    from boto.ec2.regioninfo import RegionInfo
+    endpoint = urlparse(EC2_ENDPOINT)
+    return boto.ec2.connection.EC2Connection(
+            aws_access_key_id=AWS_ACCESSKEY_ID,
+            aws_secret_access_key=AWS_ACCESSKEY_SECRET,
+            region=RegionInfo(name=EC2_REGION, endpoint=endpoint.hostname),
+            port=endpoint.port, is_secure=endpoint.scheme == "https",
+            path=endpoint.path or "/")
+
+
+@runs_once
+def refreshEC2Inventory():
+    instances = _saveEC2Inventory(_fetchEC2Instances())
+    print("%d instances of cluster %s written to %s" %
+          (len(instances), EC2_CLUSTER_NAME, EC2_INVENTORY_FILE))
+    readHostsFromEC2()
+    debugHosts()
+
@@ -368,14 +368,13 @@ def changeHadoopProperties(fileName, propertyDict):
     with cd(HADOOP_CONF):
         with settings(warn_only=True):
             import hashlib
-            replaceHadoopPropertyHash = \
-                hashlib.md5(
-                    open("replaceHadoopProperty.py", 'rb').read()
-                ).hexdigest()
-            if run("test %s = `md5sum replaceHadoopProperty.py | cut -d ' ' -f 1`"
-                   % replaceHadoopPropertyHash).failed:
-                put("replaceHadoopProperty.py", HADOOP_CONF + "/")
-                run("chmod +x replaceHadoopProperty.py")
+            # replaceHadoopProperty.py imports fileBackups.py
+            for script in ("fileBackups.py", "replaceHadoopProperty.py"):
+                scriptHash = hashlib.md5(open(script, 'rb').read()).hexdigest()
+                if run("test %s = `md5sum %s | cut -d ' ' -f 1`"
+                       % (scriptHash, script)).failed:
+                    put(script, HADOOP_CONF + "/")
+                    run("chmod +x %s" % script)
 
         with settings(warn_only=True):
             if not run("test -f %s" % fileName).failed:
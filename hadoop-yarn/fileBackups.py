@@ -0,0 +1,66 @@
+# encoding: utf-8
+"""Back up and atomically replace files.
+
+Shared by the helper scripts the fabfile runs on the nodes, and uploaded
+next to them. Backups are numbered copies, <file>.bakN, which the fabfile's
+revertBackup restores.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+def getLastBackupNumber(fileName):
+    dirName = os.path.dirname(os.path.abspath(fileName))
+    prefix = os.path.basename(fileName) + ".bak"
+    numbers = [int(entry[len(prefix):]) for entry in os.listdir(dirName)
+               if entry.startswith(prefix) and entry[len(prefix):].isdigit()]
+    return max(numbers) if numbers else -1
+
+
+def backUp(fileName):
+    """Copy fileName to the next <fileName>.bakN and return its name."""
+    backupName = "%s.bak%d" % (fileName, getLastBackupNumber(fileName) + 1)
+    shutil.copy2(fileName, backupName)
+    return backupName
+
+
+def openReplacement(fileName):
+    """Return (fd, name) of a new temporary file next to fileName, to be
+    written and then passed to replaceWith or discarded."""
+    dirName = os.path.dirname(os.path.abspath(fileName))
+    return tempfile.mkstemp(dir=dirName, prefix=".%s." % os.path.basename(fileName))
+
+
+def replaceWith(fileName, tempName):
+    """Back up fileName, if it exists, and replace it with tempName.
+
+    The file keeps its mode; a new file gets the default one.
+    """
+    if os.path.isfile(fileName):
+        backUp(fileName)
+        shutil.copymode(fileName, tempName)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tempName, 0o666 & ~umask)
+    try:
+        os.rename(tempName, fileName)
+    except OSError:
+        # e.g. /etc/hosts bind-mounted into a container can't be replaced
+        shutil.copyfile(tempName, fileName)
+        os.remove(tempName)
+
+
+def replaceContents(fileName, contents):
+    """Back up fileName, if it exists, and atomically write contents to it."""
+    fd, tempName = openReplacement(fileName)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        replaceWith(fileName, tempName)
+    except BaseException:
+        if os.path.exists(tempName):
+            os.remove(tempName)
+        raise
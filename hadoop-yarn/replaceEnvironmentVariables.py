@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import re
+import sys
+import json
+
+import fileBackups
+
+USAGE = """\
+./replaceEnvironmentVariables <file> <variables.json> [--clean]
+
+Sets every variable listed in variables.json (a list of [name, value] pairs)
+as an 'export name=value' line of file, replacing existing exports of the
+same variables and appending the missing ones. The file is backed up
+(<file>.bakN) and atomically replaced only if its contents change. With
+--clean, the variables are written to an empty file instead."""
+
+
+def mergeVariables(lines, variables):
+    """Return the merged lines and a list of (name, oldValue, newValue)."""
+    exportLine = re.compile(r"^\s*export\s+([A-Za-z_][A-Za-z0-9_]*)=(.*?)\s*$")
+    desired = dict(variables)
+    seen = {}
+    merged = []
+
+    for line in lines:
+        match = exportLine.match(line)
+        if not match or match.group(1) not in desired:
+            merged.append(line)
+            continue
+        name = match.group(1)
+        if name in seen:
+            # Drop duplicate exports, they would override the merged value
+            continue
+        seen[name] = match.group(2)
+        merged.append("export %s=%s\n" % (name, desired[name]))
+
+    changes = []
+    for name, value in variables:
+        if name not in seen:
+            merged.append("export %s=%s\n" % (name, value))
+            changes.append((name, None, value))
+        elif seen[name] != value:
+            changes.append((name, seen[name], value))
+    return merged, changes
+
+
+def main(argv):
+    if len(argv) < 3:
+        print(USAGE)
+        sys.exit(1)
+
+    fileName = argv[1]
+    with open(argv[2]) as f:
+        variables = [(str(name), str(value)) for name, value in json.load(f)]
+    clean = "--clean" in argv[3:]
+
+    lines = []
+    if os.path.isfile(fileName):
+        with open(fileName) as f:
+            lines = f.readlines()
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+
+    merged, changes = mergeVariables([] if clean else lines, variables)
+    if merged == lines:
+        print("%s: unchanged" % fileName)
+        return
+
+    fileBackups.replaceContents(fileName, "".join(merged))
+
+    print("%s:" % fileName)
+    for name, oldValue, newValue in changes:
+        if oldValue is None:
+            print("  + %s=%s" % (name, newValue))
+        else:
+            print("  ~ %s=%s (was %s)" % (name, newValue, oldValue))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,63 +1,319 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import sys
+import os
 import re
-import xml.etree.ElementTree as ElementTree
-import xml.dom.minidom as minidom
+import sys
+import json
+import hashlib
+from collections import OrderedDict
+from xml.sax.saxutils import escape, unescape
 
-if len(sys.argv) < 2 or len(sys.argv) % 2 != 0:
-    print("./replaceHadoopProperty <file> <name1> <value1> <name2> <value2> ...")
+import fileBackups
 
-fileName = sys.argv[1]
-propertyNames = sys.argv[2::2]
-propertyValues = sys.argv[3::2]
-replaced = [False] * len(propertyNames)
+USAGE = """\
+./replaceHadoopProperty [options] <file> <name1> <value1> <name2> <value2> ...
+./replaceHadoopProperty [options] <file> --json <edits.json>
+./replaceHadoopProperty [options] --batch <payload.json>
+./replaceHadoopProperty --digest --batch <payload.json>
 
-print(propertyNames)
-print(propertyValues)
+Edits are JSON objects mapping property names to values; in batch mode the
+payload maps each configuration file to its edits, e.g.
+{"core-site.xml": {"fs.defaultFS": "..."}}. Use - to read JSON from stdin.
 
-root = None
+Files are edited as a stream: only the <value> of changed properties is
+rewritten and missing properties are added at the end, leaving the rest of
+the file (formatting, comments) untouched. A file is only replaced, and
+backed up first (<file>.bakN), when something changes. With --clean the
+previous contents are moved to the backup and a fresh file is written.
 
-try:
-    tree = ElementTree.parse(fileName)
-    root = tree.getroot()
-except Exception:
-    configurationElement = ElementTree.Element("configuration")
-    tree = ElementTree.ElementTree(configurationElement)
-    root = tree.getroot()
+Options:
+  --clean      start from an empty configuration instead of merging
+  --dry-run    only report which properties would be added or changed
+  --exit-code  exit with status %d if any property was (or, with --dry-run,
+               would be) added or changed, and 0 otherwise
+  --digest     print "<file> <digest>" lines with the propertiesDigest of the
+               deployed values of the given properties, changing nothing"""
 
-for prop in root.getiterator('property'):
-    children = dict((child.tag, child) for child in prop)
+CHANGED_EXIT_CODE = 3
+USAGE = USAGE % CHANGED_EXIT_CODE
 
-    propertyName = children['name'].text.strip()
+FLAGS = ("--clean", "--dry-run", "--exit-code", "--digest")
 
-    try:
-        index = propertyNames.index(propertyName)
-        children['value'].text = propertyValues[index]
-        replaced[index] = True
-    except Exception as e:
-        print(str(e))
+CHUNK_SIZE = 1 << 16
+
+SEGMENT_START = re.compile(r"<!--|<property\b|</configuration\s*>|<configuration\s*/>")
+SEGMENT_END = {"<!--": "-->", "<property": "</property>"}
+NAME = re.compile(r"<name>\s*(.*?)\s*</name>", re.S)
+VALUE = re.compile(r"<value>(.*?)</value>|<value\s*/>", re.S)
+XML_ENTITIES = {"&quot;": '"', "&apos;": "'"}
+
+EMPTY_CONFIGURATION = '<?xml version="1.0"?>\n<configuration>\n'
+
+
+def iterSegments(f):
+    """Yield (kind, text) pieces of a configuration file, reading it in chunks.
+
+    kind is "comment", "property", "end" (the closing configuration tag),
+    "empty" (a self-closing configuration tag) or "text" for anything else.
+    """
+    buf = ""
+    eof = False
+    while True:
+        match = SEGMENT_START.search(buf)
+        if not match:
+            if eof:
+                if buf:
+                    yield "text", buf
+                return
+            # Keep a tail in case a segment start was split between chunks
+            if len(buf) > 32:
+                yield "text", buf[:-32]
+                buf = buf[-32:]
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buf += chunk
+            continue
+
+        if match.start():
+            yield "text", buf[:match.start()]
+            buf = buf[match.start():]
+
+        token = match.group(0)
+        if token not in SEGMENT_END:
+            yield ("end" if token.startswith("</") else "empty"), token
+            buf = buf[len(token):]
+            continue
+
+        endMarker = SEGMENT_END[token]
+        end = buf.find(endMarker)
+        while end < 0 and not eof:
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buf += chunk
+            end = buf.find(endMarker)
+        if end < 0:
+            yield "text", buf
+            return
+        end += len(endMarker)
+        yield ("comment" if token == "<!--" else "property"), buf[:end]
+        buf = buf[end:]
+
+
+def formatProperties(properties, indent):
+    return "".join("%(i)s<property>\n%(i)s%(i)s<name>%(name)s</name>\n"
+                   "%(i)s%(i)s<value>%(value)s</value>\n%(i)s</property>\n" %
+                   {"i": indent, "name": escape(name), "value": escape(value)}
+                   for name, value in properties.items())
+
+
+def editProperties(source, target, properties):
+    """Copy source to target setting the given properties along the way.
+
+    Returns a list of (name, oldValue, newValue) tuples, one per property,
+    where oldValue is None for properties that had to be added.
+    """
+    changes = []
+    missing = OrderedDict(properties)
+    indent = None
+    lastText = ""
+    closed = False
+
+    for kind, text in iterSegments(source):
+        if kind == "text":
+            lastText = text
+        elif kind == "property":
+            if indent is None:
+                indent = lastText[lastText.rfind("\n") + 1:]
+                if indent.strip():
+                    indent = ""
+            nameMatch = NAME.search(text)
+            name = unescape(nameMatch.group(1), XML_ENTITIES) if nameMatch else None
+            if name in missing:
+                newValue = missing.pop(name)
+                valueMatch = VALUE.search(text)
+                oldValue = unescape(valueMatch.group(1) or "", XML_ENTITIES) if valueMatch else ""
+                changes.append((name, oldValue, newValue))
+                if oldValue != newValue:
+                    newValueElement = "<value>%s</value>" % escape(newValue)
+                    if valueMatch:
+                        text = text[:valueMatch.start()] + newValueElement + text[valueMatch.end():]
+                    else:
+                        text = text[:nameMatch.end()] + newValueElement + text[nameMatch.end():]
+        elif kind in ("end", "empty") and not closed:
+            closed = True
+            added = formatProperties(missing, "\t" if indent is None else indent)
+            if kind == "empty":
+                text = "<configuration>\n%s</configuration>" % added
+            else:
+                text = ("" if not lastText or lastText.endswith("\n") else "\n") + added + text
+            changes.extend((name, None, value) for name, value in missing.items())
+            missing.clear()
+        target.write(text)
+
+    if not closed:
+        raise ValueError("no </configuration> found")
+    return changes
+
+
+def readProperties(fileName, names):
+    """Return the values of the given properties in fileName.
+
+    Properties that aren't set map to None. As in editProperties, only the
+    first definition of a property counts.
+    """
+    values = OrderedDict((name, None) for name in names)
+    if not os.path.isfile(fileName):
+        return values
+
+    pending = set(values)
+    with open(fileName) as f:
+        for kind, text in iterSegments(f):
+            if kind != "property":
+                continue
+            nameMatch = NAME.search(text)
+            name = unescape(nameMatch.group(1), XML_ENTITIES) if nameMatch else None
+            if name in pending:
+                pending.remove(name)
+                valueMatch = VALUE.search(text)
+                values[name] = unescape(valueMatch.group(1) or "", XML_ENTITIES) if valueMatch else ""
+    return values
+
+
+def toNativeString(value):
+    # Files are read and written as UTF-8 bytes on python 2, where str()
+    # fails on non-ASCII unicode values.
+    if sys.version_info[0] == 2 and isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def propertiesDigest(properties):
+    """Hash a name -> value mapping independently of its order.
+
+    The fabfile hashes the desired values with this same function, so a
+    file is in sync when both digests match.
+    """
+    canonical = json.dumps(sorted((toNativeString(name),
+                                   None if value is None else toNativeString(value))
+                                  for name, value in properties.items()))
+    return hashlib.md5(canonical.encode("utf-8")).hexdigest()
+
+
+class DiscardedOutput(object):
+    def write(self, text):
         pass
 
-for i, propertyReplaced in enumerate(replaced):
-    if not propertyReplaced:
-        newProperty = ElementTree.SubElement(root, "property")
-        newPropertyName = ElementTree.SubElement(newProperty, "name")
-        newPropertyName.text = propertyNames[i]
-        newPropertyValue = ElementTree.SubElement(newProperty, "value")
-        newPropertyValue.text = propertyValues[i]
 
-def prettify(elem):
-    """Return a pretty-printed XML string for the Element.
+def hasChanges(changes):
+    return any(oldValue != newValue for _, oldValue, newValue in changes)
+
+
+def replaceProperties(fileName, properties, clean=False, dryRun=False):
+    """Set properties (name -> value) in fileName.
+
+    The file is only backed up and replaced if a value actually changes, and
+    never in a dry run. Returns the list of changes, as documented in
+    editProperties.
     """
-    rough_string = ElementTree.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty = reparsed.toprettyxml(indent="\t")
-    prettyStr = "\n".join([line for line in pretty.split('\n') if line.strip() != ''])
-    fix = re.compile(r'((?<=>)(\n[\t]*)(?=[^<\t]))|(?<=[^>\t])(\n[\t]*)(?=<)')
-    fixedPrettyStr = re.sub(fix, '', prettyStr)
-    return fixedPrettyStr
-
-with open(fileName, "w") as f:
-    f.write(prettify(root))
+    exists = os.path.isfile(fileName)
+    merge = exists and not clean and os.path.getsize(fileName)
+
+    if dryRun:
+        if not merge:
+            return [(name, None, value) for name, value in properties.items()]
+        with open(fileName) as source:
+            return editProperties(source, DiscardedOutput(), properties)
+
+    fd, tempName = fileBackups.openReplacement(fileName)
+    try:
+        with os.fdopen(fd, "w") as target:
+            if merge:
+                with open(fileName) as source:
+                    changes = editProperties(source, target, properties)
+            else:
+                target.write(EMPTY_CONFIGURATION)
+                target.write(formatProperties(properties, "\t"))
+                target.write("</configuration>\n")
+                changes = [(name, None, value) for name, value in properties.items()]
+
+        if not hasChanges(changes):
+            os.remove(tempName)
+            return changes
+
+        fileBackups.replaceWith(fileName, tempName)
+        return changes
+    except BaseException:
+        if os.path.exists(tempName):
+            os.remove(tempName)
+        raise
+
+
+def printChanges(fileName, changes, dryRun=False):
+    added = [(name, newValue) for name, oldValue, newValue in changes if oldValue is None]
+    changed = [change for change in changes
+               if change[1] is not None and change[1] != change[2]]
+    unchanged = [name for name, oldValue, newValue in changes if oldValue == newValue]
+
+    print("%s: %d added, %d changed, %d unchanged%s" % (fileName, len(added),
+        len(changed), len(unchanged), " (dry run)" if dryRun else ""))
+    for name, newValue in added:
+        print("  + %s = %s" % (name, newValue))
+    for name, oldValue, newValue in changed:
+        print("  ~ %s = %s (was %s)" % (name, newValue, oldValue))
+    if dryRun:
+        for name in unchanged:
+            print("  = %s" % name)
+
+
+def loadJson(path):
+    if path == "-":
+        return json.load(sys.stdin, object_pairs_hook=OrderedDict)
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def toProperties(edits):
+    return OrderedDict((toNativeString(name), toNativeString(value))
+                       for name, value in edits.items())
+
+
+def parseEdits(args):
+    """Return a list of (fileName, properties) from the positional arguments."""
+    if len(args) == 2 and args[0] == "--batch":
+        payload = loadJson(args[1])
+        return [(fileName, toProperties(payload[fileName]))
+                for fileName in payload if payload[fileName]]
+
+    if len(args) == 3 and args[1] == "--json":
+        return [(args[0], toProperties(loadJson(args[2])))]
+
+    if len(args) < 1 or len(args) % 2 != 1:
+        print(USAGE)
+        sys.exit(1)
+
+    return [(args[0], OrderedDict(zip(args[1::2], args[2::2])))]
+
+
+def main(argv):
+    flags = set(arg for arg in argv[1:] if arg in FLAGS)
+    dryRun = "--dry-run" in flags
+    edits = parseEdits([arg for arg in argv[1:] if arg not in FLAGS])
+
+    if "--digest" in flags:
+        for fileName, properties in edits:
+            print("%s %s" % (fileName, propertiesDigest(readProperties(fileName, properties))))
+        return
+
+    changed = False
+    for fileName, properties in edits:
+        changes = replaceProperties(fileName, properties, "--clean" in flags, dryRun)
+        printChanges(fileName, changes, dryRun)
+        changed = changed or hasChanges(changes)
+
+    if changed and "--exit-code" in flags:
+        sys.exit(CHANGED_EXIT_CODE)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
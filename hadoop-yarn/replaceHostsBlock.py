@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import hashlib
+
+import fileBackups
+
+USAGE = """\
+./replaceHostsBlock <hosts file> <entries file>
+
+Replaces the block of the hosts file managed by the hadoop-yarn fabfile with
+the "<ip> <hostname>" lines of the entries file. Lines outside the block
+that map one of the managed IPs are dropped. The file is backed up
+(<file>.bakN) and atomically replaced, unless the block is already up to
+date, which is detected through the hash recorded in its first line."""
+
+BLOCK_BEGIN = "# BEGIN hadoop-yarn hosts"
+BLOCK_END = "# END hadoop-yarn hosts"
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(USAGE)
+        sys.exit(1)
+
+    hostsFile, entriesFile = argv[1:]
+    with open(entriesFile) as f:
+        entries = [line.split() for line in f if line.strip()]
+    digest = hashlib.md5("".join("%s %s\n" % tuple(entry) for entry in entries)
+                         .encode("utf-8")).hexdigest()
+    header = "%s %s" % (BLOCK_BEGIN, digest)
+
+    lines = []
+    if os.path.isfile(hostsFile):
+        with open(hostsFile) as f:
+            lines = f.read().splitlines()
+    if header in lines:
+        print("%s: unchanged" % hostsFile)
+        return
+
+    managedIps = set(entry[0] for entry in entries)
+    kept = []
+    inBlock = False
+    for line in lines:
+        if line.startswith(BLOCK_BEGIN):
+            inBlock = True
+        elif line == BLOCK_END:
+            inBlock = False
+        elif not inBlock and (not line.split() or line.split()[0] not in managedIps):
+            kept.append(line)
+
+    block = [header] + ["%s %s" % tuple(entry) for entry in entries] + [BLOCK_END]
+    fileBackups.replaceContents(hostsFile, "\n".join(kept + block) + "\n")
+    print("%s: %d managed entries written" % (hostsFile, len(entries)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -21,7 +21,13 @@
 #   have to dive into the DON'T CHANGE section but it shouldn't
 #   be too hard.
 
+import os
+import sys
 from fabric.api import run, cd, env, settings, put, sudo
+from fabric.decorators import runs_once
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fabsupport import tracing
 
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
@@ -53,6 +59,7 @@ MASTER_REQUIREMENTS = ["openjdk-7-jre-headless", "git"] + DEBIAN_32_COMPAT
 # Packages that should be installed on the slave hosts
 SLAVE_REQUIREMENTS = ["openjdk-7-jre-headless", "git", "php5", "php5-json", 
     "ant"] + DEBIAN_32_COMPAT
+
 ##############################################################
 #  END OF YOUR CONFIGURATION (CHANGE UNTIL HERE, IF NEEDED)  #
 ##############################################################
@@ -66,14 +73,22 @@ PACKAGE_MANAGER_UPDATE = "apt-get update"
 # Debian/Ubuntu
 # If no hosts provided via the argument, try using
 # hardcoded ones
-if not env.hosts:
-    env.hosts = [JENKINS_MASTER_HOST] + JENKINS_SLAVE_HOSTS
+if not env.hosts and not env.roles:
+    env.hosts = [host for host in [JENKINS_MASTER_HOST] + JENKINS_SLAVE_HOSTS if host]
+
+# The master is the first host. Only checked once a task needs it, so that
+# tasks can still be listed without any hosts.
+def _getMasterHost():
+    # If no hardcoded hosts, quit
+    if not env.hosts:
+        raise Exception("No hosts specified")
+    return env.hosts[0]
 
-# If no hardcoded hosts, quit
-if not env.hosts:
-    raise Exception("No hosts specified")
+tracing.install(globals())
 
-JENKINS_MASTER_HOST = env.hosts[0]
+@runs_once
+def benchmarkStartup(count=5):
+    tracing.benchmark_startup(__file__, count)
 
 # Main functions
 def setup():
@@ -81,7 +96,7 @@ def setup():
     setupSlave()
 
 def setupMaster():
-    if env.host == JENKINS_MASTER_HOST:
+    if env.host == _getMasterHost():
         print("+ Setting up Master")
         installMasterDependencies()
         installJenkins()
@@ -7,12 +7,17 @@
 #   in a cluster.
 
 import os
+import sys
 import tempfile
 import textwrap
 from fabric.api import run, cd, env, settings, put, sudo
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fabsupport import artifacts, journal, tracing
+from fabsupport.batch import CommandBatch as _CommandBatch
+
 env.password = "password"
 
 # Packages info
@@ -32,6 +37,15 @@ PNP4NAGIOS_VERSION = "0.6.25"
 PNP4NAGIOS_PACKAGE = "pnp4nagios-{}".format(PNP4NAGIOS_VERSION)
 PNP4NAGIOS_URL = "http://liquidtelecom.dl.sourceforge.net/project/pnp4nagios/PNP-0.6/{package}.tar.gz".format(package=PNP4NAGIOS_PACKAGE)
 
+# sha256 checksums that downloaded packages must match, by URL
+PACKAGE_SHA256 = {}
+
+# Completed install steps are recorded on each host together with a
+# fingerprint of their inputs (versions, URLs, settings). Steps whose inputs
+# haven't changed since are skipped on later runs. Use resetJournal, or
+# fab --set ignore_journal=1, to redo them anyway.
+STATE_JOURNAL = "~/.nagios-journal"
+
 # Cluster info
 CLUSTER_MASTER = "grafos01"
 CLUSTER_WORKERS = ["grafos01", "grafos02", "grafos03"]
@@ -90,16 +104,36 @@ POSTINSTALL_COMMANDS = [
 ]
 
 def bootstrapFabric():
+    # Hosts or roles given with -H/-R take precedence over the cluster. The
+    # private IPs are only retrieved once a task needs them.
+    if not env.hosts and not env.roles:
+        env.hosts = _getClusterHosts()
+
+
+def _getClusterHosts():
     hosts = [CLUSTER_MASTER] + CLUSTER_WORKERS
     seen = set()
     # Remove empty hosts and duplicates
-    cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
-    env.hosts = cleanedHosts
+    return [host for host in hosts if host and host not in seen and not seen.add(host)]
 
-    retrieveClusterInformation()
 
-    print("Hosts to IPS:")
-    print(CLUSTER_PRIVATE_IPS)
+tracing.install(globals())
+
+
+# STATE JOURNAL
+def _journaledStep(getInputs):
+    return journal.journaled_step(STATE_JOURNAL, getInputs)
+
+
+def resetJournal():
+    journal.reset_journal(STATE_JOURNAL)
+
+
+@runs_once
+def benchmarkStartup(count=5):
+    # The private IPs of the cluster are only retrieved by the tasks that
+    # use them, not to list the tasks
+    tracing.benchmark_startup(__file__, count)
 
 
 # MAIN FUNCTIONS
@@ -110,8 +144,12 @@ def install():
     installPlugins()
     installNRPE()
     installPNP4Nagios()
+    # Not journaled: the pushed configuration comes from files in this
+    # directory, which the install steps don't fingerprint
+    updateConfig()
     restartNagios()
 
+@_journaledStep(lambda: (PREINSTALL_COMMANDS, INSTALL_COMMAND, DEPENDENCIES, POSTINSTALL_COMMANDS))
 def installDependencies():
     for command in PREINSTALL_COMMANDS:
         sudo(command)
@@ -121,14 +159,17 @@ def installDependencies():
         sudo(command)
 
 
+@_journaledStep(lambda: (NAGIOS_USER, NAGIOS_GROUP))
 def addUserAndGroup():
     with settings(warn_only=True):
-        if run_with_settings("id {NAGIOS_USER}").failed:
-            sudo_with_settings("useradd {NAGIOS_USER}")
-            sudo_with_settings("groupadd {NAGIOS_GROUP}")
-            sudo_with_settings("usermod -a -G {NAGIOS_GROUP} {NAGIOS_USER}")
+        if _run_with_settings("id {NAGIOS_USER}").failed:
+            _sudo_with_settings("useradd {NAGIOS_USER}")
+            _sudo_with_settings("groupadd {NAGIOS_GROUP}")
+            _sudo_with_settings("usermod -a -G {NAGIOS_GROUP} {NAGIOS_USER}")
 
 
+@_journaledStep(lambda: (NAGIOS_CORE_URL, CLUSTER_MASTER, NAGIOS_USER, NAGIOS_GROUP,
+    SENDMAIL_BIN, APACHE2_CONFD, NAGIOS_HTTP_USER, NAGIOS_HTTP_PASSWORD))
 def installCore():
     if not env.host == CLUSTER_MASTER:
         return
@@ -138,75 +179,69 @@ def installCore():
             print("Core already installed.")
             return
 
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NAGIOS_CORE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NAGIOS_CORE_PACKAGE, NAGIOS_CORE_URL))
+    _distributeArtifact(NAGIOS_CORE_URL, "%s.tar.gz" % NAGIOS_CORE_PACKAGE, [CLUSTER_MASTER])
     run("tar --overwrite -xf %s.tar.gz" % NAGIOS_CORE_PACKAGE)
 
-    with cd(NAGIOS_CORE_PACKAGE):
-        run_with_settings("./configure --with-nagios-group={NAGIOS_USER} --with-command-group={NAGIOS_GROUP} --with-mail={SENDMAIL_BIN} --with-httpd-conf={APACHE2_CONFD}")
-        run("make all")
-        sudo("make install")
-        sudo("make install-init")
-        sudo("make install-config")
-        sudo("make install-commandmode")
-        sudo("make install-webconf")
-        sudo("cp -R contrib/eventhandlers/ /usr/local/nagios/libexec")
-        sudo_with_settings("chown -R {NAGIOS_USER}:{NAGIOS_USER} /usr/local/nagios/libexec/eventhandlers")
-        sudo("/usr/local/nagios/bin/nagios -v /usr/local/nagios/etc/nagios.cfg")
-        sudo_with_settings("/etc/init.d/{APACHE2_DAEMON} restart")
-        sudo_with_settings("htpasswd -cb /usr/local/nagios/etc/htpasswd.users {NAGIOS_HTTP_USER} {NAGIOS_HTTP_PASSWORD}")
-        sudo("ln -s /etc/init.d/nagios /etc/rcS.d/S99nagios")
-
-
+    with _CommandBatch("nagios-core") as batch, cd(NAGIOS_CORE_PACKAGE):
+        batch.run("./configure --with-nagios-group={NAGIOS_USER} --with-command-group={NAGIOS_GROUP} --with-mail={SENDMAIL_BIN} --with-httpd-conf={APACHE2_CONFD}".format(**globals()))
+        batch.run("make all")
+        batch.sudo("make install")
+        batch.sudo("make install-init")
+        batch.sudo("make install-config")
+        batch.sudo("make install-commandmode")
+        batch.sudo("make install-webconf")
+        batch.sudo("cp -R contrib/eventhandlers/ /usr/local/nagios/libexec")
+        batch.sudo("chown -R {NAGIOS_USER}:{NAGIOS_USER} /usr/local/nagios/libexec/eventhandlers".format(**globals()))
+        batch.sudo("/usr/local/nagios/bin/nagios -v /usr/local/nagios/etc/nagios.cfg")
+        batch.sudo("/etc/init.d/{APACHE2_DAEMON} restart".format(**globals()))
+        batch.sudo("htpasswd -cb /usr/local/nagios/etc/htpasswd.users {NAGIOS_HTTP_USER} {NAGIOS_HTTP_PASSWORD}".format(**globals()))
+        batch.sudo("ln -s /etc/init.d/nagios /etc/rcS.d/S99nagios")
+
+
+@_journaledStep(lambda: (NAGIOS_PLUGINS_URL, NAGIOS_USER))
 def installPlugins():
-    with settings(warn_only=True):
-        if run("test -f {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE)).failed:
-            run("wget -O {}.tar.gz {}".format(NAGIOS_PLUGINS_PACKAGE, NAGIOS_PLUGINS_URL))
+    _distributeArtifact(NAGIOS_PLUGINS_URL, "{}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE))
     run("tar --overwrite -xf {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE))
 
-    with cd(NAGIOS_PLUGINS_PACKAGE):
-        run_with_settings("./configure --with-nagios-group={NAGIOS_USER} --with-nagios-user={NAGIOS_USER}")
-        run_with_settings("make")
-        sudo_with_settings("make install")
+    with _CommandBatch("nagios-plugins") as batch, cd(NAGIOS_PLUGINS_PACKAGE):
+        batch.run("./configure --with-nagios-group={NAGIOS_USER} --with-nagios-user={NAGIOS_USER}".format(**globals()))
+        batch.run("make")
+        batch.sudo("make install")
 
 
+@_journaledStep(lambda: (NRPE_URL, CLUSTER_MASTER, CLUSTER_WORKERS, _getClusterPrivateIps(),
+    NRPE_SERVICES, NAGIOS_USER, NAGIOS_GROUP))
 def installNRPE():
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NRPE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NRPE_PACKAGE, NRPE_URL))
+    _distributeArtifact(NRPE_URL, "%s.tar.gz" % NRPE_PACKAGE)
     run("tar --overwrite -xf %s.tar.gz" % NRPE_PACKAGE)
 
-    with cd(NRPE_PACKAGE):
-        run_with_settings("./configure --enable-ssl --with-ssl=/usr/bin/openssl --with-ssl-lib=/usr/lib/x86_64-linux-gnu")
-        run_with_settings("make all")
+    with _CommandBatch("nrpe") as batch, cd(NRPE_PACKAGE):
+        batch.run("./configure --enable-ssl --with-ssl=/usr/bin/openssl --with-ssl-lib=/usr/lib/x86_64-linux-gnu")
+        batch.run("make all")
         if env.host in CLUSTER_WORKERS:
-            sudo_with_settings("make install-plugin")
-            sudo_with_settings("make install-daemon")
-            sudo_with_settings("make install-daemon-config")
-            sudo_with_settings("make install-xinetd")
-            addLinesToFile("/etc/services", ["nrpe\t5666/tcp\tNRPE"])
+            batch.sudo("make install-plugin")
+            batch.sudo("make install-daemon")
+            batch.sudo("make install-daemon-config")
+            batch.sudo("make install-xinetd")
         if env.host == CLUSTER_MASTER:
-            sudo_with_settings("make install-daemon")
-    updateNPREConfig()
+            batch.sudo("make install-daemon")
+    if env.host in CLUSTER_WORKERS:
+        addLinesToFile("/etc/services", ["nrpe\t5666/tcp\tNRPE"])
 
 
+@_journaledStep(lambda: (PNP4NAGIOS_URL, CLUSTER_MASTER))
 def installPNP4Nagios():
     if not env.host == CLUSTER_MASTER:
         return
 
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % PNP4NAGIOS_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (PNP4NAGIOS_PACKAGE, PNP4NAGIOS_URL))
+    _distributeArtifact(PNP4NAGIOS_URL, "%s.tar.gz" % PNP4NAGIOS_PACKAGE, [CLUSTER_MASTER])
     run("tar --overwrite -xf %s.tar.gz" % PNP4NAGIOS_PACKAGE)
 
-    with cd(PNP4NAGIOS_PACKAGE):
-        run_with_settings("./configure")
-        run_with_settings("make all")
-        sudo_with_settings("make fullinstall")
-        sudo_with_settings("service {APACHE2_DAEMON} restart")
-
-    configurePNP4Nagios()
+    with _CommandBatch("pnp4nagios") as batch, cd(PNP4NAGIOS_PACKAGE):
+        batch.run("./configure")
+        batch.run("make all")
+        batch.sudo("make fullinstall")
+        batch.sudo("service {APACHE2_DAEMON} restart".format(**globals()))
 
 
 def configurePNP4Nagios():
@@ -238,7 +273,7 @@ def updateConfig():
     configurePNP4Nagios()
 
 def updateNPREConfig():
-    put_with_settings("xinetd_nrpe", "/etc/xinetd.d/nrpe", use_sudo=True)
+    _put_with_settings("xinetd_nrpe", "/etc/xinetd.d/nrpe", use_sudo=True)
 
     if env.host in CLUSTER_WORKERS:
         configureNRPESlaves()
@@ -248,40 +283,40 @@ def updateNPREConfig():
 
 def startNagios():
     if env.host in CLUSTER_WORKERS:
-        sudo_with_settings("service xinetd start")
+        _sudo_with_settings("service xinetd start")
 
     if env.host == CLUSTER_MASTER:
-        sudo_with_settings("service nagios start")
-        sudo_with_settings("service npcd start")
+        _sudo_with_settings("service nagios start")
+        _sudo_with_settings("service npcd start")
 
 def stopNagios():
     if env.host == CLUSTER_MASTER:
-        sudo_with_settings("service nagios stop")
-        sudo_with_settings("service npcd stop")
+        _sudo_with_settings("service nagios stop")
+        _sudo_with_settings("service npcd stop")
 
 def restartNagios():
     if env.host in CLUSTER_WORKERS:
-        sudo_with_settings("service xinetd restart")
+        _sudo_with_settings("service xinetd restart")
 
     if env.host == CLUSTER_MASTER:
-        sudo_with_settings("service nagios restart")
-        sudo_with_settings("service npcd restart")
+        _sudo_with_settings("service nagios restart")
+        _sudo_with_settings("service npcd restart")
 
 
 def installChecks():
     put("check_iostat", "/usr/local/nagios/libexec/check_iostat", use_sudo=True)
-    sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_iostat")
+    _sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_iostat")
     sudo("chmod 755 /usr/local/nagios/libexec/check_iostat")
     put("check_netint.pl", "/usr/local/nagios/libexec/check_netint.pl", use_sudo=True)
-    sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_netint.pl")
+    _sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_netint.pl")
     sudo("chmod 755 /usr/local/nagios/libexec/check_netint.pl")
     put("check_linux_stats.pl", "/usr/local/nagios/libexec/check_linux_stats.pl", use_sudo=True)
-    sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_linux_stats.pl")
+    _sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/libexec/check_linux_stats.pl")
     sudo("chmod 755 /usr/local/nagios/libexec/check_linux_stats.pl")
 
 def configureNRPESlaves():
     put("slave_nrpe_config", "/usr/local/nagios/etc/nrpe.cfg", use_sudo=True)
-    sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/etc/nrpe.cfg")
+    _sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/etc/nrpe.cfg")
     installChecks()
 
 def configureNRPEMaster():
@@ -308,7 +343,7 @@ def addHostsToConfig():
     config_parts = []
 
     for worker in CLUSTER_WORKERS:
-        config_parts.append(host_config_base.format(hostname=worker, address=CLUSTER_PRIVATE_IPS[worker]))
+        config_parts.append(host_config_base.format(hostname=worker, address=_getClusterPrivateIps()[worker]))
 
     sudo("echo \"{hosts}\" >> \"{file}\"".format(hosts="\n".join(config_parts), file="/usr/local/nagios/etc/hosts.cfg"))
 
@@ -333,63 +368,62 @@ def addServicesToConfig():
 
 def addCommandsToConfig():
     put("commands.cfg", "/usr/local/nagios/etc/objects/commands.cfg", use_sudo=True)
-    sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/etc/objects/commands.cfg")
+    _sudo_with_settings("chown {NAGIOS_USER} /usr/local/nagios/etc/objects/commands.cfg")
 
 
 def addLinesToFile(cfg_file, lines):
-    with settings(warn_only=True):
-        if not sudo("test -f {}".format(cfg_file)).failed:
-            currentBakNumber = getLastBackupNumber(cfg_file) + 1
-            sudo("cp {file} {file}.bak{bakNumber}".format(file=cfg_file, bakNumber=currentBakNumber))
+    # Backup, create and append in a single round trip
+    commands = ["if [ -f {file} ]; then "
+                "n=$(ls -1 {file}.bak* 2>/dev/null | sed -n 's/^.*\\.bak\\([0-9][0-9]*\\)$/\\1/p' | sort -n | tail -n 1); "
+                "cp {file} {file}.bak$((${{n:--1}} + 1)); fi".format(file=cfg_file),
+                "touch {}".format(cfg_file)]
+    for line in lines:
+        commands.append("grep -q -F -x '{line}' {file} || echo '{line}' >> {file}".format(line=line, file=cfg_file))
+    sudo(" && ".join(commands))
 
-    sudo("touch %s" % cfg_file)
 
-    for line in lines:
-        lineNumber = sudo("grep -n -F -x '{line}' '{file}' | cut -d : -f 1".format(line=line, file=cfg_file))
-        try:
-            lineNumber = int(lineNumber)
-            # Line already exists
-            pass
-        except ValueError:
-            sudo("echo '{line}' >> \"{file}\"".format(line=line, file=cfg_file))
-
-
-def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
-    fileName = os.path.basename(filePath)
-
-    with cd(dirName):
-        latestBak = sudo("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
+def _distributeArtifact(url, remotePath, hosts=None):
+    artifacts.distribute_artifact(url, remotePath, PACKAGE_SHA256.get(url), hosts)
+
 
 CLUSTER_PRIVATE_IPS = {}
 CLUSTER_MASTER_IP = None
 
 @runs_once
-def retrieveClusterInformation():
+def _retrieveClusterInformation():
     global CLUSTER_PRIVATE_IPS
     global CLUSTER_MASTER_IP
 
-    private_ips = execute(getPrivateIp)
+    private_ips = execute(getPrivateIp, hosts=_getClusterHosts())
 
     CLUSTER_PRIVATE_IPS = private_ips
     CLUSTER_MASTER_IP = CLUSTER_PRIVATE_IPS[CLUSTER_MASTER]
 
+    print("Hosts to IPS:")
+    print(CLUSTER_PRIVATE_IPS)
+
+def _getClusterPrivateIps():
+    _retrieveClusterInformation()
+    return CLUSTER_PRIVATE_IPS
+
 @parallel
 def getPrivateIp():
     return run("ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE).strip()
 
 
-def run_with_settings(command):
-    return run(command.format(**globals()))
+def _format_with_settings(text):
+    # Only sweep the cluster for its IPs when the text refers to them
+    if "{CLUSTER_MASTER_IP" in text or "{CLUSTER_PRIVATE_IPS" in text:
+        _retrieveClusterInformation()
+    return text.format(**globals())
+
+def _run_with_settings(command):
+    return run(_format_with_settings(command))
 
-def sudo_with_settings(command):
-    return sudo(command.format(**globals()))
+def _sudo_with_settings(command):
+    return sudo(_format_with_settings(command))
 
-def put_with_settings(local_path, remote_path, use_sudo=False):
+def _put_with_settings(local_path, remote_path, use_sudo=False):
     temp_file = None
 
     try:
@@ -397,7 +431,7 @@ def put_with_settings(local_path, remote_path, use_sudo=False):
 
         with open(local_path, 'r') as base_file:
             base_file_contents = base_file.read()
-            temp_file.write(base_file_contents.format(**globals()))
+            temp_file.write(_format_with_settings(base_file_contents))
     finally:
         if temp_file:
             temp_file.close()